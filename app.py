@@ -1,11 +1,43 @@
-from flask import Flask, render_template, redirect, url_for, abort, request
+from bisect import bisect_left
+from flask import Flask, Response, render_template, redirect, url_for, abort, request, send_from_directory
+from typing import Callable, Hashable, Iterable
+from werkzeug.security import safe_join
+from likes import LikesStore
 from random import randrange
+import atexit
+import hashlib
 import json
-import threading
 import os
+import re
+import threading
+import time
+
+
+class ComicApp(Flask):
+    def send_static_file(self, filename: str) -> Response:
+        """
+        Serves a static file with a strong ETag of its contents. Requests for
+        the fingerprinted URLs that `url_for` generates are cached for good,
+        since a change to the file changes its URL.
+        """
+        fingerprint = static_fingerprint(filename)
+        if fingerprint is None:
+            abort(404)
+
+        immutable = request.args.get('v') == fingerprint
+        response = send_from_directory(
+            self.static_folder, filename, etag=fingerprint,
+            max_age=STATIC_MAX_AGE if immutable else self.get_send_file_max_age(filename))
+        if immutable:
+            response.cache_control.immutable = True
+        return response
+
 
+app = ComicApp(__name__)
 
-app = Flask(__name__)
+
+STATIC_MAX_AGE = 365 * 24 * 60 * 60
+"""Seconds that browsers can cache a static file requested by its fingerprinted URL."""
 
 
 STRIPS_PER_PAGE = 10
@@ -13,109 +45,413 @@ STRIPS_PER_PAGE = 10
 
 
 DATABASE_FILE = os.environ.get("DATABASE_PATH", "database.json")
-'''File to load/save our "database".'''
+'''File to load/save our "database". Votes since it was last saved are logged to `DATABASE_FILE.log`.'''
+
+
+LIKES_WRITE_BEHIND = os.environ.get("LIKES_WRITE_BEHIND", "") == "1"
+'''
+Whether to write votes to disk from a background thread in batches, rather
+than before responding. Votes from the last `LIKES_FLUSH_MS` can be lost if
+the server crashes.
+'''
+
+
+LIKES_FLUSH_MS = int(os.environ.get("LIKES_FLUSH_MS", "100"))
+'''How often queued votes are written to disk, with `LIKES_WRITE_BEHIND`.'''
+
+
+LIKES_FLUSH_VOTES = int(os.environ.get("LIKES_FLUSH_VOTES", "100"))
+'''Number of queued votes that are written to disk straight away, with `LIKES_WRITE_BEHIND`.'''
+
+
+LIKES_FSYNC = os.environ.get("LIKES_FSYNC", "") == "1"
+'''Whether to sync votes to disk, so they survive a machine crash and not just a server crash.'''
+
+
+LIKES_KEY = os.environ.get("LIKES_KEY")
+'''
+Key for hashing voters' IP addresses, in hex. If unset, it's kept in
+`DATABASE_FILE.key`, which must not be shared along with the database.
+'''
 
 
 POSTS_FILE = "posts.json"
 '''File containing all post metadata.'''
 
 
-posts = []
-'''List of all posts loaded from posts.json.'''
+DERIVATIVES_DIR = "comics/derived"
+'''Directory under static/ with the resized WebP versions of each comic, generated by comic.py.'''
+
+
+DERIVATIVE_PATTERN = re.compile(r'^(?P<stem>.+)-(?P<width>\d+)w\.webp$')
+'''Pattern for the names of the resized comics, e.g. `comic-001-540w.webp`.'''
+
+
+POSTS_POLL_SECONDS = float(os.environ.get("POSTS_POLL_SECONDS", "2"))
+'''How often to check posts.json for changes, so new posts show up without a restart. 0 disables it.'''
+
+
+database: LikesStore
+'''Our "database" of likes, which we load from disk.'''
+
+
+class Ranking:
+    """
+    Published post IDs ordered by likes, most liked first, for the top page.
+
+    The order is kept up to date as votes come in, so a page of it can be
+    read without sorting every post. Posts with the same number of likes stay
+    in the order they appear in posts.json.
+    """
+
+    def __init__(self, ids: list[int], likes: dict[int, int]):
+        self.lock = threading.Lock()
+        self.position = {id: index for index, id in enumerate(ids)}
+        self.likes = dict(likes)
+
+        # Sorted list of (-likes, position, id), so that the most liked posts
+        # come first and ties are broken by position.
+        self.keys = sorted((-self.likes[id], self.position[id], id) for id in ids)
+
+    def update(self, id: int, likes: int) -> tuple[int, int] | None:
+        """
+        Moves post `id` to its place in the order for its new number of likes.
+
+        Returns: The post's old and new index in the order, or None if it
+        didn't change.
+        """
+        with self.lock:
+            old_likes = self.likes.get(id)
+            if old_likes is None or old_likes == likes:
+                return None
+
+            old_index = bisect_left(self.keys, (-old_likes, self.position[id], id))
+            del self.keys[old_index]
+
+            key = (-likes, self.position[id], id)
+            new_index = bisect_left(self.keys, key)
+            self.keys.insert(new_index, key)
+            self.likes[id] = likes
+
+        return old_index, new_index
+
+    def page(self, start: int, end: int) -> list[int]:
+        """Returns the IDs of the posts ranked from `start` up to `end`."""
+        with self.lock:
+            return [id for _, _, id in self.keys[start:end]]
+
+
+class PostIndex:
+    """
+    Everything we derive from posts.json and the published comics.
+
+    An index is built in full before it's used, and replaced rather than
+    changed, so a request that holds on to one never sees half of an old
+    index and half of a new one.
+    """
+
+    def __init__(self, posts: list[dict], derivatives: dict[str, list[tuple[int, str]]], stamp: tuple):
+        self.posts = posts
+        '''List of all posts loaded from posts.json.'''
+
+        self.published_posts = {post['id']: post for post in posts if post.get('published', False)}
+        '''Dict of published posts keyed by ID.'''
+
+        self.published_post_ids = [post['id'] for post in posts if post.get('published', False)]
+        '''List of published post IDs (preserving file order) for quick random selection.'''
+
+        self.latest_published_id = self.published_post_ids[-1] if self.published_post_ids else 1
+        '''ID of the most recent published post, or 1 if none.'''
+
+        # Split the published IDs into archive pages up front, newest first.
+        ordered_ids = list(reversed(self.published_post_ids))
+        self.archive_pages = [ordered_ids[i:i + STRIPS_PER_PAGE] for i in range(0, len(ordered_ids), STRIPS_PER_PAGE)]
+        '''The published post IDs on each page of the archive, newest first.'''
 
+        self.archive_page_of = {id: index + 1 for index, page_ids in enumerate(self.archive_pages) for id in page_ids}
+        '''The archive page (1-based) each published post ID appears on.'''
 
-published_posts = {}
-'''Dict of published posts keyed by ID.'''
+        self.derivatives = derivatives
+        '''The (width, file name) of each resized version of each comic, keyed by the comic's file name.'''
 
+        self.ranking = Ranking(self.published_post_ids, {id: database.get(str(id)) for id in self.published_post_ids})
+        '''Published posts ordered by likes.'''
 
-latest_published_id = 1
-'''ID of the most recent published post.'''
+        self.stamp = stamp
+        '''The `posts_stamp` of the files this index was built from.'''
 
-published_post_ids: list[int] = []
-'''List of published post IDs for quick random selection.'''
 
+post_index: PostIndex
+'''The current index of posts. Read it once per request, as it's replaced when posts.json changes.'''
 
-database_lock = threading.Lock()
-'''Lock that must be acquired before reading/writing to the "database".'''
 
+class PageCache:
+    """
+    Rendered HTML for each page, keyed by (route, page), along with a weak
+    ETag of its contents.
 
-database = {}
-'''Our "database", i.e. a dict that we load from disk.'''
+    Pages only change when a post is published or a vote comes in, so they're
+    rendered once and served from here until `invalidate` is called for them.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pages: dict[Hashable, tuple[str, str]] = {}
+
+        # Incremented when a key is invalidated, or for every key when the
+        # cache is cleared, so that a page that was being rendered at the time
+        # isn't cached with stale contents.
+        self.versions: dict[Hashable, int] = {}
+        self.generation = 0
+
+    def get(self, key: Hashable, render: Callable[[], str]) -> tuple[str, str]:
+        """
+        Returns the cached page for `key` and its ETag, rendering it with
+        `render` if needed.
+        """
+        with self.lock:
+            page = self.pages.get(key)
+            version = (self.generation, self.versions.get(key, 0))
+        if page is not None:
+            return page
+
+        html = render()
+        page = (html, hashlib.sha256(html.encode()).hexdigest()[:16])
+        with self.lock:
+            if (self.generation, self.versions.get(key, 0)) == version:
+                self.pages[key] = page
+        return page
+
+    def response(self, key: Hashable, render: Callable[[], str]) -> Response:
+        """
+        Returns a response with the cached page for `key`, or a 304 if the
+        request's `If-None-Match` shows the client already has it.
+        """
+        html, etag = self.get(key, render)
+        response = Response(html, mimetype='text/html')
+        response.set_etag(etag, weak=True)
+
+        # Let browsers keep the page, but check that it's current each time.
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
+
+    def invalidate(self, keys: Iterable[Hashable]):
+        with self.lock:
+            for key in keys:
+                self.pages.pop(key, None)
+                self.versions[key] = self.versions.get(key, 0) + 1
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.pages.clear()
+
+
+page_cache = PageCache()
+'''Rendered pages, invalidated as posts and likes change.'''
+
+
+static_fingerprints: dict[str, tuple[int, int, str]] = {}
+'''Content hash of each static file, along with its mtime and size when hashed.'''
+
+
+def static_fingerprint(filename: str) -> str | None:
+    """Returns a hash of the contents of the static file `filename`, or None if it doesn't exist."""
+    path = safe_join(app.static_folder, filename)
+    if path is None:
+        return None
+
+    try:
+        stat = os.stat(path)
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+
+    cached = static_fingerprints.get(filename)
+    if cached is not None and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+        return cached[2]
+
+    with open(path, 'rb') as f:
+        fingerprint = hashlib.sha256(f.read()).hexdigest()[:16]
+    static_fingerprints[filename] = (stat.st_mtime_ns, stat.st_size, fingerprint)
+    return fingerprint
+
+
+@app.url_defaults
+def fingerprint_static_urls(endpoint: str, values: dict):
+    """Adds the file's fingerprint to static URLs, so they change whenever the file does."""
+    if endpoint == 'static' and 'filename' in values:
+        fingerprint = static_fingerprint(values['filename'])
+        if fingerprint is not None:
+            values['v'] = fingerprint
 
 
 def load_database():
     global database
-    with database_lock:
+    database = LikesStore(
+        DATABASE_FILE, write_behind=LIKES_WRITE_BEHIND, flush_interval=LIKES_FLUSH_MS / 1000,
+        flush_votes=LIKES_FLUSH_VOTES, fsync=LIKES_FSYNC,
+        on_change=lambda id, likes: likes_changed(int(id)),
+        key=bytes.fromhex(LIKES_KEY) if LIKES_KEY else None)
+
+    # Write out any queued votes when the worker shuts down.
+    atexit.register(database.close)
+
+
+def posts_stamp() -> tuple:
+    """
+    Returns the modification times and sizes of posts.json and the directory of
+    resized comics, which change whenever a post is published.
+    """
+    stamp = []
+    for path in (POSTS_FILE, os.path.join(app.static_folder, DERIVATIVES_DIR)):
         try:
-            with open(DATABASE_FILE, 'r') as f:
-                database = json.load(f)
+            stat = os.stat(path)
+            stamp.append((stat.st_mtime_ns, stat.st_size))
         except FileNotFoundError:
-            # Initialize with proper structure if file doesn't exist.
-            database = {'likes': {}}
-            with open(DATABASE_FILE, 'w') as f:
-                json.dump(database, f, indent=4)
-
-        # Ensure the database has the expected structure.
-        if 'likes' not in database:
-            database['likes'] = {}
+            stamp.append(None)
+    return tuple(stamp)
 
 
 def load_posts():
-    global posts, published_posts, latest_published_id, published_post_ids
+    global post_index
+    # Take the stamp first, so that a change made while we're loading is
+    # picked up by the next check.
+    stamp = posts_stamp()
     with open(POSTS_FILE, 'r') as f:
         posts = json.load(f)
 
-    # Build dict of published posts keyed by ID
-    published_posts = { post['id']: post for post in posts if post.get('published', False) }
-    # Build list of published post IDs (preserving file order)
-    published_post_ids = [post['id'] for post in posts if post.get('published', False)]
+    index = PostIndex(posts, load_derivatives(), stamp)
+    post_index = index
+
+    # Votes cast while the ranking was being built may have been applied to
+    # the old one, so bring the new one up to date.
+    for id in index.published_post_ids:
+        index.ranking.update(id, database.get(str(id)))
+
+    # Every page may have changed.
+    page_cache.clear()
 
-    # Latest is the last published ID (preserving file order), or 1 if none
-    latest_published_id = published_post_ids[-1] if published_post_ids else 1
+
+def watch_posts():
+    """Reloads the posts whenever posts.json or the resized comics change, until the process exits."""
+    # The stamp of the last version that failed to load, so that it's only
+    # reported once rather than on every poll until it's fixed.
+    failed_stamp = None
+
+    while True:
+        time.sleep(POSTS_POLL_SECONDS)
+        stamp = posts_stamp()
+        if stamp == post_index.stamp or stamp == failed_stamp:
+            continue
+
+        try:
+            load_posts()
+            app.logger.info("Reloaded %s", POSTS_FILE)
+        except (OSError, ValueError) as e:
+            # posts.json may be half written, so keep the current posts and
+            # try again once it changes.
+            failed_stamp = stamp
+            app.logger.warning("Failed to reload %s: %s", POSTS_FILE, e)
+
+
+watcher_pid = None
+'''ID of the process the posts watcher was started in.'''
+
+
+@app.before_request
+def start_watching_posts():
+    """
+    Starts the posts watcher in this process, if it isn't running yet. Every
+    worker watches posts.json for itself, so they all pick up a change
+    within `POSTS_POLL_SECONDS` of each other without having to talk to
+    each other. This is done on the first request rather than at import
+    time, since threads don't survive gunicorn forking a preloaded app.
+    """
+    global watcher_pid
+    if POSTS_POLL_SECONDS <= 0 or watcher_pid == os.getpid():
+        return
+
+    watcher_pid = os.getpid()
+    threading.Thread(target=watch_posts, name="posts-watcher", daemon=True).start()
+
+
+@app.before_request
+def sync_likes():
+    """
+    Picks up votes cast through other workers since the last request, so that
+    every worker shows the same counts. This only costs a `stat` of the log
+    when there are none.
+    """
+    database.sync()
+
+
+def load_derivatives() -> dict[str, list[tuple[int, str]]]:
+    """Finds the resized versions of each comic in `DERIVATIVES_DIR`."""
+    found: dict[str, list[tuple[int, str]]] = {}
+    try:
+        names = os.listdir(os.path.join(app.static_folder, DERIVATIVES_DIR))
+    except FileNotFoundError:
+        names = []
+
+    for name in names:
+        match = DERIVATIVE_PATTERN.match(name)
+        if match:
+            found.setdefault(f"{match['stem']}.png", []).append((int(match['width']), name))
+
+    return {file: sorted(versions) for file, versions in found.items()}
 
 
 # Why define a function when we're just going to invoke it immediately?
-load_posts()
 load_database()
+load_posts()
 
 
 # TODO: Make this a class I guess?
-def strip(id: int) -> dict | None:
+def strip(id: int, index: PostIndex) -> dict | None:
     # Lookup published post by ID (only published available)
-    post = published_posts.get(id)
+    post = index.published_posts.get(id)
     if post is None:
         return None
 
-    with database_lock:
-        likes = database['likes'].get(str(id), {}).get('likes', 0)
+    likes = database.get(str(id))
 
     # Create a copy of the post and add likes and comic URL.
     result = post.copy()
     result['likes'] = likes
     result['url'] = url_for('static', filename=f"comics/{post['file']}")
+    result['srcset'] = ', '.join(
+        f"{url_for('static', filename=f'{DERIVATIVES_DIR}/{name}')} {width}w"
+        for width, name in index.derivatives.get(post['file'], []))
     return result
 
 
 @app.route("/")
 @app.route("/comic/")
 def comic_latest():
-    num_pages = len(published_posts)
-    return render_template("comic.html.jinja", strip=strip(latest_published_id), page=latest_published_id, num_pages=num_pages, route='comic')
+    index = post_index
+    return render_comic(index.latest_published_id, index)
 
 
 @app.route("/comic/<int:page>")
 def comic(page: int):
     # Validate the page number - check if it's a published post
-    if page not in published_posts:
+    index = post_index
+    if page not in index.published_posts:
         abort(404)
 
-    num_pages = len(published_posts)
-    return render_template("comic.html.jinja", strip=strip(page), page=page, num_pages=num_pages, route='comic')
+    return render_comic(page, index)
+
+
+def render_comic(page: int, index: PostIndex) -> Response:
+    num_pages = len(index.published_posts)
+    return page_cache.response(('comic', page), lambda: render_template(
+        "comic.html.jinja", strip=strip(page, index), page=page, num_pages=num_pages, route='comic'))
 
 
 @app.route("/random")
 def random():
-    random_id = published_post_ids[randrange(len(published_post_ids))]
+    index = post_index
+    random_id = index.published_post_ids[randrange(len(index.published_post_ids))]
     return redirect(url_for('comic', page=random_id))
 
 
@@ -126,56 +462,58 @@ def archive_home():
 
 @app.route("/archive/<int:page>")
 def archive(page: int):
-    # Calculate total pages.
-    num_published = len(published_posts)
-    num_pages = (num_published + STRIPS_PER_PAGE - 1) // STRIPS_PER_PAGE
-
     # Validate the page number.
+    index = post_index
+    num_pages = len(index.archive_pages)
     if page < 1 or page > num_pages:
         abort(404)
 
-    # Calculate start and end indices.
-    start_index = (page - 1) * STRIPS_PER_PAGE
-    end_index = page * STRIPS_PER_PAGE
-
-    # Ordered published IDs newest first using precomputed list
-    ordered_ids = list(reversed(published_post_ids))
-    page_ids = ordered_ids[start_index:end_index]
-    strips = [strip(i) for i in page_ids]
-
-    return render_template('archive.html.jinja', strips=strips, page=page, num_pages=num_pages, route='archive')
+    def render():
+        strips = [strip(i, index) for i in index.archive_pages[page - 1]]
+        return render_template('archive.html.jinja', strips=strips, page=page, num_pages=num_pages, route='archive')
+
+    return page_cache.response(('archive', page), render)
+
+
+def likes_changed(id: int):
+    """
+    Moves post `id` in the ranking for its current number of likes, and drops
+    the cached pages that show them: its own page, its archive page, and the
+    top pages it moved across.
+    """
+    # Look the likes up rather than passing them in, so that if two threads
+    # race to update the ranking, the last one leaves it up to date.
+    index = post_index
+    moved = index.ranking.update(id, database.get(str(id)))
+    if moved is not None:
+        first_index, last_index = sorted(moved)
+        top_pages = range(first_index // STRIPS_PER_PAGE + 1, last_index // STRIPS_PER_PAGE + 2)
+        page_cache.invalidate([
+            ('comic', id),
+            ('archive', index.archive_page_of[id]),
+            *(('top', top_page) for top_page in top_pages),
+        ])
 
 
 @app.post("/like/<int:id>")
 def like(id: int):
     # Validate the comic number - check if it's a published post
-    if id not in published_posts:
+    index = post_index
+    if id not in index.published_posts:
         abort(404)
 
-    # Update the likes for the comic.
-    with database_lock:
-        comic_data = database['likes'].setdefault(str(id), {})
-        likes = comic_data.setdefault('likes', 0)
-
-        # Check the request's IP address to check for duplicate votes. We only
-        # allow one vote per so that it's at least not trivial to cast votes.
-        #
-        # NOTE: This way of getting the IP address won't work if we run the
-        # server behind a reverse proxy, because every request will have the
-        # proxy's IP. If we end up doing that, we'll have to instead look at the
-        # headers to see what the original IP was. But that approach has
-        # additional details to consider, so we're going with the simple
-        # approach to start.
-        ip = request.remote_addr
-        votes = comic_data.setdefault('votes', [])
-        if ip not in votes:
-            likes += 1
-            comic_data['likes'] = likes
-            votes.append(ip)
-
-            # Update the database on disk with the new data.
-            with open(DATABASE_FILE, 'w') as database_file:
-                json.dump(database, database_file, indent=4)
+    # Update the likes for the comic, using the request's IP address to check
+    # for duplicate votes. We only allow one vote per so that it's at least
+    # not trivial to cast votes.
+    #
+    # NOTE: This way of getting the IP address won't work if we run the
+    # server behind a reverse proxy, because every request will have the
+    # proxy's IP. If we end up doing that, we'll have to instead look at the
+    # headers to see what the original IP was. But that approach has
+    # additional details to consider, so we're going with the simple
+    # approach to start.
+    likes = database.like(str(id), request.remote_addr)
+    likes_changed(id)
 
     return {
         'likes': likes,
@@ -190,7 +528,8 @@ def top_home():
 @app.route("/top/<int:page>")
 def top(page: int):
     # Calculate total pages.
-    num_published = len(published_posts)
+    index = post_index
+    num_published = len(index.published_posts)
     num_pages = (num_published + STRIPS_PER_PAGE - 1) // STRIPS_PER_PAGE
 
     # Validate the page number.
@@ -201,9 +540,20 @@ def top(page: int):
     start_index = (page - 1) * STRIPS_PER_PAGE
     end_index = page * STRIPS_PER_PAGE
 
-    # Generate the list of strips sorted by likes.
-    strips = [s for s in (strip(i) for i in published_post_ids) if s is not None]
-    strips = sorted(strips, key=lambda s: s['likes'], reverse=True)
-    strips = strips[start_index:end_index]
+    def render():
+        # Look up the page of strips in the ranking, which is kept sorted by likes.
+        strips = [s for s in (strip(i, index) for i in index.ranking.page(start_index, end_index)) if s is not None]
+        return render_template('archive.html.jinja', strips=strips, page=page, num_pages=num_pages, route='top')
+
+    return page_cache.response(('top', page), render)
+
 
-    return render_template('archive.html.jinja', strips=strips, page=page, num_pages=num_pages, route='top')
+@app.route("/likes")
+def likes():
+    """
+    Returns the current likes for the comma-separated comic IDs in the `ids`
+    query parameter, so pages can show up-to-date counts.
+    """
+    ids = [int(id) for id in request.args.get('ids', '').split(',') if id.isdigit()]
+    index = post_index
+    return {str(id): database.get(str(id)) for id in ids if id in index.published_posts}
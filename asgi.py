@@ -0,0 +1,45 @@
+from asgiref.wsgi import WsgiToAsgi
+import json
+import re
+
+import app as site
+
+
+LIKE_PATH = re.compile(r'^/like/(?P<id>\d+)$')
+'''Path of the like endpoint, matching the `/like/<int:id>` route.'''
+
+
+wsgi_app = WsgiToAsgi(site.app)
+'''The Flask app, which handles everything but likes in a worker thread.'''
+
+
+async def app(scope, receive, send):
+    """
+    Serves the site to an ASGI server, e.g. `uvicorn asgi:app`.
+
+    Likes are handled here on the event loop, so that with
+    `LIKES_WRITE_BEHIND` a vote never waits for a thread. Anything else,
+    including likes that would be errors, is passed on to the Flask app.
+    """
+    match = LIKE_PATH.match(scope.get('path', '')) if scope['type'] == 'http' else None
+    client = scope.get('client')
+    if match is None or scope['method'] != 'POST' or client is None:
+        await wsgi_app(scope, receive, send)
+        return
+
+    id = int(match['id'])
+    if id not in site.post_index.published_posts:
+        await wsgi_app(scope, receive, send)
+        return
+
+    # See `site.like` for why votes are by IP address.
+    likes = await site.database.like_async(str(id), client[0])
+    site.likes_changed(id)
+
+    body = json.dumps({'likes': likes}, separators=(',', ':')).encode() + b'\n'
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())],
+    })
+    await send({'type': 'http.response.body', 'body': body})
@@ -0,0 +1,478 @@
+from PIL import Image
+from contextlib import redirect_stdout
+from typing import Callable, List, Optional
+import argparse
+import http.client
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import resource
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import unicodedata
+
+import comic
+import fake_openai
+from likes import LikesStore
+
+
+EMOJI_CHAT_LINE = (
+    "<arbo> lmao 😂😂😂 did you see that 👀 "
+    "👩🏽‍💻 is shipping again 🚀🚀 ❤️ 1️⃣ 🇺🇸 "
+    "👨‍👩‍👧‍👦 brought cake 🍰🎉 hell yeah 🔥🔥🔥 "
+)
+"""A chat line mixing plain text with single emoji and emoji sequences."""
+
+
+SAMPLE_DIALOG = [
+    "<arbo> did anyone else see the thing on the news this morning 😂 absolutely unhinged",
+    "<malk> no what happened",
+    "<arbo> a guy tried to pay for his coffee with a live lobster 🦞",
+    "<Arbo> and they accepted it??",
+    "<@malk> honestly respect ❤️",
+    "<laura> 👩🏽‍💻 adding this to the bit",
+]
+"""Six lines of dialog for benchmarking comic construction."""
+
+
+PIPELINE_MODES = [
+    ("sequential", ["-j", "1", "--no-batch-prompts"]),
+    ("concurrent", ["-j", "3"]),
+    ("concurrent, b64", ["-j", "3", "--b64"]),
+    ("batch, 2 at once", ["--batch", "scripts", "--jobs", "2"]),
+]
+"""Names and `comic.py` arguments of the ways of generating strips to compare."""
+
+
+LOAD_ROUTES = ["/", "/archive/{page}", "/top/{page}", "/like/{id}"]
+"""Routes of app.py to load test. Likes cycle through every published comic."""
+
+
+def legacy_is_emoji(char):
+    """
+    The original per-character emoji check, kept as a baseline for `emoji`.
+    """
+    return (
+        unicodedata.category(char) == 'So' or
+        char in ['\u2764', '\u2665', '\u2763']
+        or '\U0001F600' <= char <= '\U0001F64F'
+        or '\U0001F300' <= char <= '\U0001F5FF'
+        or '\U0001F680' <= char <= '\U0001F6FF'
+        or '\U0001F1E0' <= char <= '\U0001F1FF'
+        or '\U00002600' <= char <= '\U000026FF'
+        or '\U00002700' <= char <= '\U000027BF'
+    )
+
+
+def legacy_split_text_by_font(text):
+    """
+    The original character-by-character segmentation, kept as a baseline for
+    `emoji`.
+    """
+    segments = []
+    current_segment = ""
+    current_is_emoji = None
+
+    for char in text:
+        char_is_emoji = legacy_is_emoji(char)
+
+        if current_is_emoji is None:
+            current_is_emoji = char_is_emoji
+            current_segment = char
+        elif current_is_emoji == char_is_emoji:
+            current_segment += char
+        else:
+            if current_segment:
+                segments.append((current_segment, current_is_emoji))
+            current_segment = char
+            current_is_emoji = char_is_emoji
+
+    if current_segment:
+        segments.append((current_segment, current_is_emoji))
+
+    return segments
+
+
+def time_it(fn: Callable[[], object], iterations: int) -> float:
+    """Returns the average time (in seconds) of calling `fn`."""
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations
+
+
+def bench_emoji(args):
+    """Compares emoji segmentation of long, emoji-heavy chat lines."""
+    text = EMOJI_CHAT_LINE * args.repeat
+
+    # Build the lookup table up front so it isn't counted against the first run.
+    comic.emoji_table()
+
+    legacy = time_it(lambda: legacy_split_text_by_font(text), args.iterations)
+    current = time_it(lambda: comic.split_text_by_font(text), args.iterations)
+
+    print(f"Line length: {len(text)} characters")
+    print(f"legacy split_text_by_font: {legacy * 1000:.3f} ms")
+    print(f"split_text_by_font:        {current * 1000:.3f} ms ({legacy / current:.2f}x)")
+
+
+def write_sample_panels(directory: str):
+    """Writes three noisy 1024x1792 panels, the size DALL-E generates, to `directory`."""
+    for p in (1, 2, 3):
+        panel = Image.merge("RGB", [Image.effect_noise((1024, 1792), 40 + 20 * i) for i in range(3)])
+        panel.save(os.path.join(directory, f"panel_{p}.png"))
+
+
+def peak_rss_mb() -> float:
+    """Returns the peak resident set size of this process, in MiB."""
+    # ru_maxrss is reported in KiB on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_isolated(fn: Callable, *args):
+    """
+    Runs `fn(*args)` in a fresh process and returns its result, so that its
+    peak memory isn't affected by anything run before it.
+    """
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        return pool.apply(fn, args)
+
+
+def construct_comic_worker(directory: str, iterations: int, direct: bool):
+    """Times `construct_comic` in `directory` and reports the process's peak memory."""
+    os.chdir(directory)
+    baseline_rss = peak_rss_mb()
+
+    elapsed = time_it(
+        lambda: comic.construct_comic(SAMPLE_DIALOG, rotate_panels=[2], panel_shifts=[(1, 150)], direct=direct),
+        iterations)
+
+    return elapsed, peak_rss_mb(), baseline_rss
+
+
+def bench_render(args):
+    """Compares drawing the comic at full size and downscaling with drawing it at output size."""
+    with tempfile.TemporaryDirectory() as directory:
+        write_sample_panels(directory)
+
+        for name, direct in [("full size + downscale", False), ("output size", True)]:
+            elapsed, peak, baseline = run_isolated(construct_comic_worker, directory, args.iterations, direct)
+            print(f"{name:22} {elapsed * 1000:8.1f} ms   peak RSS {peak:7.1f} MiB ({peak - baseline:+.1f} MiB)")
+
+
+def pipeline_worker(directory: str, strips: int, args: List[str], env: dict):
+    """
+    Runs `comic.py` with `args` against the fake backend in `directory`, once
+    per strip (or once for all of them in batch mode), and returns the wall
+    time and `construct_comic` time of each strip, and the peak memory.
+    """
+    os.chdir(directory)
+    os.environ.update(env)
+
+    # Synthesize the fake images up front so it isn't counted against the first strip.
+    for variant in range(fake_openai.IMAGE_VARIANTS):
+        fake_openai.synthesize_image(variant)
+
+    baseline_rss = peak_rss_mb()
+
+    batch = "--batch" in args
+    runs = 1 if batch else strips
+    argv = ["comic.py", "--backend", "fake", "--no-cache", "-l", "office", *args]
+
+    wall_times = []
+    for _ in range(runs):
+        comic.tracer = comic.Tracer()
+        sys.argv = argv
+
+        start = time.perf_counter()
+        try:
+            with redirect_stdout(io.StringIO()):
+                comic.main()
+        except SystemExit as e:
+            if e.code:
+                raise RuntimeError(f"comic.py {' '.join(args)} exited with {e.code}")
+        wall_times.append(time.perf_counter() - start)
+
+    construct_times = [span["duration"] for span in comic.tracer.spans if span["name"] == "construct_comic"]
+    if batch:
+        wall_times = [wall_times[0] / strips] * strips
+
+    return wall_times, construct_times, peak_rss_mb(), baseline_rss
+
+
+def bench_pipeline(args):
+    """Runs the full comic.py flow against the fake backend in each generation mode."""
+    env = {
+        "FAKE_OPENAI_CHAT_LATENCY": str(args.chat_latency),
+        "FAKE_OPENAI_IMAGE_LATENCY": str(args.image_latency),
+        "FAKE_OPENAI_FAILURE_RATE": str(args.failure_rate),
+        "FAKE_OPENAI_SEED": "0",
+    }
+
+    print(f"{args.strips} strips per mode, chat latency {args.chat_latency}s, "
+          f"image latency {args.image_latency}s, failure rate {args.failure_rate:.0%}")
+    print(f"{'mode':18} {'per strip':>10} {'min':>8} {'max':>8} {'construct':>10} {'peak RSS':>10}")
+
+    for name, mode_args in PIPELINE_MODES:
+        if args.mode and name.split(",")[0] not in args.mode:
+            continue
+
+        with tempfile.TemporaryDirectory() as directory:
+            script = "\n".join(f"10:{i:02} AM {line}" for i, line in enumerate(SAMPLE_DIALOG))
+            with open(os.path.join(directory, "script.txt"), "w", encoding="utf-8") as f:
+                f.write(script)
+            os.mkdir(os.path.join(directory, "scripts"))
+            for i in range(args.strips):
+                with open(os.path.join(directory, "scripts", f"{i}.txt"), "w", encoding="utf-8") as f:
+                    f.write(script)
+
+            wall_times, construct_times, peak, baseline = run_isolated(
+                pipeline_worker, directory, args.strips, mode_args, env)
+
+        print(
+            f"{name:18} {statistics.mean(wall_times):9.2f}s {min(wall_times):7.2f}s {max(wall_times):7.2f}s "
+            f"{statistics.mean(construct_times) * 1000:8.1f}ms {peak:7.1f} MiB ({peak - baseline:+.1f} MiB)")
+
+
+def bench_png(args):
+    """Compares the size and encode time of each PNG profile on published comics."""
+    names = sorted(f for f in os.listdir(comic.COMICS_DIR) if f.endswith('.png'))[-args.comics:]
+    images = []
+    for name in names:
+        with Image.open(os.path.join(comic.COMICS_DIR, name)) as image:
+            images.append(image.convert('RGB'))
+
+    print(f"{len(images)} comics from {comic.COMICS_DIR}")
+    with tempfile.TemporaryDirectory() as directory:
+        file_name = os.path.join(directory, "comic.png")
+        for profile in comic.PNG_PROFILES:
+            results = [comic.encode_png(image, file_name, profile) for image in images]
+            size = statistics.mean(r["bytes"] for r in results)
+            seconds = statistics.mean(r["seconds"] for r in results)
+            palettes = sum(r["palette"] for r in results)
+            print(f"{profile:10} {size / 1024:9,.0f} KiB {seconds * 1000:8.1f} ms   {palettes} with a palette")
+
+
+load_client = None
+"""The Flask test client of a `load` worker process, when testing in-process."""
+
+
+def load_worker_init(env: dict, in_process: bool):
+    """Sets up a `load` worker process, loading the app if it's tested in-process."""
+    global load_client
+    os.environ.update(env)
+    if in_process:
+        import app
+        load_client = app.app.test_client()
+
+
+def load_worker(address: Optional[tuple], route: str, ids: List[int], duration: float, worker: int) -> tuple:
+    """
+    Requests `route` for `duration` seconds, from the test client or from the
+    server at `address`.
+
+    Returns: A tuple of (the latency of each request, the likes database's
+    `stats` after liking with the test client, or None).
+    """
+    likes = route.startswith("/like/")
+    latencies = []
+    deadline = time.perf_counter() + duration
+
+    for i in itertools.count():
+        path = route.format(page=1, id=ids[i % len(ids)])
+        start = time.perf_counter()
+
+        if address is None:
+            # Each vote comes from a new address, so every one is counted.
+            environ = {"REMOTE_ADDR": f"10.{worker}.{i >> 8 & 255}.{i & 255}"}
+            response = load_client.open(path, method="POST" if likes else "GET", environ_base=environ)
+            status = response.status_code
+            response.close()
+        else:
+            connection = http.client.HTTPConnection(*address)
+            connection.request("POST" if likes else "GET", path)
+            response = connection.getresponse()
+            response.read()
+            status = response.status
+            connection.close()
+
+        now = time.perf_counter()
+        if status >= 400:
+            raise RuntimeError(f"{path} returned {status}")
+        latencies.append(now - start)
+        if now >= deadline:
+            break
+
+    stats = None
+    if likes and address is None:
+        import app
+        stats = app.database.stats()
+    return latencies, stats
+
+
+def start_gunicorn(workers: int, env: dict, preload: bool) -> tuple:
+    """
+    Starts gunicorn serving app.py with `workers` workers, loading the app
+    before forking them if `preload` is set, and waits until it accepts
+    connections.
+
+    Returns: A tuple of (the gunicorn process, the address it's listening on).
+    """
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        address = s.getsockname()
+
+    server = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-w", str(workers), "-b", "%s:%d" % address,
+         *(["--preload"] if preload else []), "app:app"],
+        env={**os.environ, **env}, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    deadline = time.monotonic() + 30
+    while True:
+        try:
+            socket.create_connection(address, timeout=1).close()
+            return server, address
+        except OSError:
+            if server.poll() is not None or time.monotonic() > deadline:
+                server.kill()
+                raise RuntimeError("gunicorn didn't start")
+            time.sleep(0.1)
+
+
+def preload_app(env: dict):
+    """Loads app.py in this process, using the database in `env`, so that it's inherited by forked workers."""
+    os.environ.update(env)
+    import app
+    app.database.close()
+    app.DATABASE_FILE = env["DATABASE_PATH"]
+    app.load_database()
+    app.load_posts()
+
+
+def check_likes(database_file: str, votes: int):
+    """Checks that all `votes` cast were recorded in `database_file`."""
+    database = LikesStore(database_file)
+    recorded = sum(database.likes.values())
+    database.close()
+
+    if recorded != votes:
+        raise RuntimeError(f"Only {recorded} of {votes} likes were recorded")
+
+
+def format_likes_stats(stats: List[dict]) -> str:
+    """Summarizes the writes to the likes log made by every worker, from each worker's `LikesStore.stats`."""
+    flushes = sum(s["flushes"] for s in stats)
+    flushed_votes = sum(s["flushed_votes"] for s in stats)
+    mean_flush_ms = sum(s["mean_flush_ms"] * s["flushes"] for s in stats) / flushes if flushes else 0.0
+    return (
+        f"log: {flushed_votes} votes in {flushes} writes, mean {mean_flush_ms:.2f}ms, "
+        f"max {max(s['max_flush_ms'] for s in stats):.2f}ms, {sum(s['queue_depth'] for s in stats)} still queued")
+
+
+def bench_load(args):
+    """Load tests app.py, reporting throughput and latency of each route with several numbers of workers."""
+    with open("posts.json", "r") as f:
+        ids = [post["id"] for post in json.load(f) if post.get("published", False)]
+
+    in_process = args.server == "test-client"
+    print(f"{args.duration}s per route, {'in-process test clients' if in_process else 'gunicorn'}, "
+          f"{'write-behind' if args.write_behind else 'synchronous'} likes"
+          f"{', app loaded before forking workers' if args.preload else ''}")
+    if not in_process:
+        print(f"{args.clients} client processes; likes all come from one address, so only the first of each counts")
+    print(f"{'workers':>7} {'route':16} {'requests':>9} {'req/s':>9} {'p50':>9} {'p99':>9}")
+
+    with tempfile.TemporaryDirectory() as directory:
+        for workers in args.workers:
+            # Each run starts from no likes, and doesn't touch the real database.
+            env = {
+                "DATABASE_PATH": os.path.join(directory, f"likes-{workers}.json"),
+                "LIKES_WRITE_BEHIND": "1" if args.write_behind else "",
+                "POSTS_POLL_SECONDS": "0",
+            }
+
+            # In-process, each worker is a process with its own test client,
+            # sharing the database as gunicorn workers would. With `preload`,
+            # the app is loaded here and the workers are forked from this
+            # process, as with `gunicorn --preload`.
+            context = multiprocessing.get_context("spawn")
+            if in_process and args.preload:
+                context = multiprocessing.get_context("fork")
+                preload_app(env)
+
+            server, address = (None, None) if in_process else start_gunicorn(workers, env, args.preload)
+            clients = workers if in_process else args.clients
+            try:
+                with context.Pool(clients, load_worker_init, (env, in_process)) as pool:
+                    for route in LOAD_ROUTES:
+                        results = pool.starmap(
+                            load_worker, [(address, route, ids, args.duration, n) for n in range(clients)])
+                        latencies = list(itertools.chain.from_iterable(result[0] for result in results))
+                        percentiles = statistics.quantiles(latencies, n=100)
+                        print(
+                            f"{workers:7} {route.format(page='N', id='N'):16} {len(latencies):9} "
+                            f"{len(latencies) / args.duration:9.0f} {percentiles[49] * 1000:7.2f}ms "
+                            f"{percentiles[98] * 1000:7.2f}ms")
+
+                        stats = [result[1] for result in results if result[1] is not None]
+                        if stats:
+                            print(f"{'':7} {'':16} {format_likes_stats(stats)}")
+
+                        # Every vote from the test clients is from a new
+                        # address, so each one should be counted. Votes
+                        # queued with write-behind aren't written until the
+                        # workers exit cleanly, which pool workers don't.
+                        if route.startswith("/like/") and in_process and not args.write_behind:
+                            check_likes(env["DATABASE_PATH"], len(latencies))
+            finally:
+                if server is not None:
+                    server.terminate()
+                    server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for the comic pipeline.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    emoji = subparsers.add_parser('emoji', help=bench_emoji.__doc__)
+    emoji.add_argument('-n', '--iterations', type=int, default=200, help='Number of times to run each function. Defaults to 200.')
+    emoji.add_argument('--repeat', type=int, default=20, help='Number of times to repeat the sample chat line. Defaults to 20.')
+    emoji.set_defaults(func=bench_emoji)
+
+    render = subparsers.add_parser('render', help=bench_render.__doc__)
+    render.add_argument('-n', '--iterations', type=int, default=5, help='Number of comics to construct with each path. Defaults to 5.')
+    render.set_defaults(func=bench_render)
+
+    pipeline = subparsers.add_parser('pipeline', help=bench_pipeline.__doc__)
+    pipeline.add_argument('-n', '--strips', type=int, default=4, help='Number of strips to generate with each mode. Defaults to 4.')
+    pipeline.add_argument('--mode', nargs='+', choices=['sequential', 'concurrent', 'batch'], help='Modes to run. Defaults to all of them.')
+    pipeline.add_argument('--chat-latency', type=float, default=0.5, help='Seconds each fake chat completion takes. Defaults to 0.5.')
+    pipeline.add_argument('--image-latency', type=float, default=2.0, help='Seconds each fake image generation takes. Defaults to 2.')
+    pipeline.add_argument('--failure-rate', type=float, default=0.0, help='Chance that each fake API call fails with a transient error. Defaults to 0.')
+    pipeline.set_defaults(func=bench_pipeline)
+
+    png = subparsers.add_parser('png', help=bench_png.__doc__)
+    png.add_argument('-n', '--comics', type=int, default=5, help='Number of the most recent comics to encode. Defaults to 5.')
+    png.set_defaults(func=bench_png)
+
+    load = subparsers.add_parser('load', help=bench_load.__doc__)
+    load.add_argument('-w', '--workers', type=int, nargs='+', default=[1, 2, 4], help='Numbers of workers to compare. Defaults to 1, 2 and 4.')
+    load.add_argument('-d', '--duration', type=float, default=3.0, help='Seconds to load test each route for. Defaults to 3.')
+    load.add_argument('--server', choices=['test-client', 'gunicorn'], default='test-client', help='Whether to test the app in-process with the Flask test client, or over HTTP with gunicorn. Defaults to test-client.')
+    load.add_argument('-c', '--clients', type=int, default=4, help='Number of client processes sending requests to gunicorn. Defaults to 4.')
+    load.add_argument('--write-behind', action='store_true', help='Write likes to disk in the background, as with LIKES_WRITE_BEHIND=1.')
+    load.add_argument('--preload', action='store_true', help='Load the app before forking the workers, as with gunicorn --preload.')
+    load.set_defaults(func=bench_load)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
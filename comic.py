@@ -1,12 +1,28 @@
 from openai import OpenAI
-from PIL import Image, ImageDraw, ImageFont
-from typing import Union, List, Optional
+import openai
+from PIL import Image, ImageChops, ImageDraw, ImageFont, ImageStat
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import Union, List, Optional, Dict
+from urllib.parse import parse_qs, urlparse
 import argparse
+import atexit
+import base64
+import hashlib
+import io
 import json
 import random
+import re
 import requests
 import shutil
 import os
+import threading
+import time
 import unicodedata
 
 
@@ -14,6 +30,80 @@ COMICS_DIR = "static/comics"
 """Directory where comics are published."""
 
 
+DERIVATIVES_DIR = os.path.join(COMICS_DIR, "derived")
+"""Directory for the resized WebP versions of published comics."""
+
+
+DERIVATIVE_WIDTHS = (540, 1080)
+"""
+Widths of the resized versions of each comic, alongside a WebP at its full
+width. 1080 is the width comics are shown at, and 540 suits phones.
+"""
+
+
+DERIVATIVE_QUALITY = 85
+"""WebP quality of the resized comics."""
+
+
+PNG_PROFILES = {
+    "fast": {"save": {"compress_level": 1}, "palette": None},
+    "balanced": {"save": {"compress_level": 6}, "palette": "exact"},
+    "max": {"save": {"optimize": True}, "palette": "close"},
+}
+"""
+Settings for encoding comics as PNG, from quickest to smallest:
+
+- fast: Light deflate. About 10% larger than balanced in half the time.
+- balanced: Pillow's default deflate, and an exact palette when the comic
+  has no more than 256 colors.
+- max: Maximum deflate, and a 256 color palette when it's within
+  `PALETTE_MAX_RMS` of the original, which is worth it for large flat areas.
+"""
+
+
+PALETTE_MAX_RMS = 1.0
+"""
+Largest RMS difference per channel (out of 255) from the original for which
+the max profile uses a 256 color version of a comic.
+"""
+
+
+REGULAR_FONT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "FiraCode-Bold.ttf")
+"""Font used for dialog text."""
+
+
+EMOJI_FONT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "NotoEmoji.ttf")
+"""Font used for emoji in dialog text."""
+
+
+OUTPUT_SCALE = 0.5
+"""Size of the saved comic strip relative to the size of the generated panels."""
+
+
+PREVIEW_SCALE = 0.25
+"""Size of the images served by the preview server relative to the size of the generated panels."""
+
+
+MANIFEST_FILE = "comic_manifest.json"
+"""File recording the stages completed by a resumable (--resume) run."""
+
+
+ARTIFACTS_DIR = ".artifacts"
+"""Directory where the output of each stage of a resumable run is stored."""
+
+
+PROMPT_CACHE_DIR = ".prompt_cache"
+"""Directory where cached chat completion responses are stored."""
+
+
+PROMPT_CACHE_MAX_ENTRIES = 1000
+"""Maximum number of responses kept in the prompt cache before evicting the oldest."""
+
+
+PROMPT_CACHE_MAX_AGE = 30 * 24 * 60 * 60
+"""Maximum age (in seconds) of a cached response before it is discarded."""
+
+
 CHARACTERS = {
     "arbo": "A robot with a beard, dressed in a blue vest, smoking a cigarette.",
     "blah64": "A futuristic fighter pilot in an orange jumpsuit and helmet.",
@@ -71,10 +161,517 @@ LOCATIONS = {
 }
 
 
-def generate_panel(client: OpenAI, p: int, dialog_lines: List[str], speakers: List[str], location: str, max_tries: int = 3):
-    i = p - 1
+class Tracer:
+    """
+    Records how long each stage of the pipeline takes.
 
-    location_description = LOCATIONS[location]
+    Spans are recorded with `span`, which times the block it wraps and lets
+    the block attach attributes such as token counts or bytes downloaded.
+    Recording is thread-safe, so panels generated in parallel can be traced.
+    """
+
+    def __init__(self):
+        self.spans: List[dict] = []
+        self.start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name: str, **attrs):
+        """
+        Times the wrapped block as a span called `name`. Yields the span's
+        attributes, which the block can add to.
+        """
+        start = time.perf_counter()
+        try:
+            yield attrs
+        except BaseException as e:
+            attrs["error"] = type(e).__name__
+            raise
+        finally:
+            span = {
+                "name": name,
+                "start": start - self.start,
+                "duration": time.perf_counter() - start,
+                "thread": threading.get_ident(),
+                "attrs": attrs,
+            }
+            with self._lock:
+                self.spans.append(span)
+
+    def reset(self):
+        """Drops the spans recorded so far, and restarts the wall clock."""
+        with self._lock:
+            self.spans = []
+            self.start = time.perf_counter()
+
+    def summary(self) -> str:
+        """
+        Returns a table with the count, total and mean duration of each kind
+        of span, along with the totals of any numeric attributes.
+        """
+        with self._lock:
+            spans = list(self.spans)
+
+        stats: Dict[str, dict] = {}
+        for span in spans:
+            stat = stats.setdefault(span["name"], {"count": 0, "total": 0.0, "max": 0.0, "totals": {}})
+            stat["count"] += 1
+            stat["total"] += span["duration"]
+            stat["max"] = max(stat["max"], span["duration"])
+            for key, value in span["attrs"].items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool) and key != "panel":
+                    stat["totals"][key] = stat["totals"].get(key, 0) + value
+
+        lines = [f"{'span':<18} {'count':>5} {'total':>9} {'mean':>9} {'max':>9}  totals"]
+        for name, stat in sorted(stats.items(), key=lambda item: -item[1]["total"]):
+            totals = ", ".join(f"{key}={value:,}" for key, value in sorted(stat["totals"].items()))
+            lines.append(
+                f"{name:<18} {stat['count']:>5} {stat['total']:>8.2f}s {stat['total'] / stat['count']:>8.3f}s "
+                f"{stat['max']:>8.3f}s  {totals}")
+        lines.append(f"Wall time: {time.perf_counter() - self.start:.2f}s")
+        return "\n".join(lines)
+
+    def write(self, file_name: str):
+        """
+        Writes the spans to `file_name` in the Chrome trace event format,
+        which can be viewed with Perfetto or chrome://tracing.
+        """
+        with self._lock:
+            spans = list(self.spans)
+
+        events = [
+            {
+                "name": span["name"],
+                "ph": "X",
+                "ts": span["start"] * 1e6,
+                "dur": span["duration"] * 1e6,
+                "pid": os.getpid(),
+                "tid": span["thread"],
+                "args": span["attrs"],
+            }
+            for span in spans
+        ]
+        with open(file_name, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": events}, f, indent=1)
+
+
+tracer = Tracer()
+"""Tracer that records the timing of every stage of the run."""
+
+
+verbose = False
+"""Print the full prompts sent to, and responses received from, the chat API."""
+
+
+png_profile = "balanced"
+"""The `PNG_PROFILES` entry used to encode comic_strip.png."""
+
+
+class PromptCache:
+    """
+    Persistent cache of chat completion responses, stored as one JSON file
+    per request in `cache_dir`.
+
+    Entries are keyed by a hash of the model, system prompt and messages, so a
+    rerun with the same script skips the round-trip entirely. Entries older
+    than `max_age` seconds are ignored, and the oldest entries are evicted
+    once there are more than `max_entries` of them.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str = PROMPT_CACHE_DIR,
+        max_entries: int = PROMPT_CACHE_MAX_ENTRIES,
+        max_age: float = PROMPT_CACHE_MAX_AGE,
+        refresh: bool = False,
+    ):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.refresh = refresh
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(model: str, system: Optional[str], messages: List[str], json_mode: bool = False) -> str:
+        """Returns the cache key for a request."""
+        request = {"model": model, "system": system, "messages": messages}
+        if json_mode:
+            request["json_mode"] = True
+        payload = json.dumps(request, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Returns the cached response for `key`, or None on a miss. Always
+        misses when the cache is being refreshed.
+        """
+        response = None
+        if not self.refresh:
+            try:
+                path = self._path(key)
+                if time.time() - os.path.getmtime(path) <= self.max_age:
+                    with open(path, "r", encoding="utf-8") as f:
+                        response = json.load(f)["response"]
+            except (FileNotFoundError, ValueError, KeyError):
+                response = None
+
+        with self._lock:
+            if response is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        return response
+
+    def put(self, key: str, response: str):
+        """Stores `response` under `key` and evicts any excess entries."""
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        # Write to a temp file and rename it into place so that concurrent
+        # readers never see a partially written entry.
+        path = self._path(key)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump({"response": response}, f)
+        os.replace(temp_path, path)
+
+        self.evict()
+
+    def evict(self):
+        """Removes expired entries, then the oldest entries beyond `max_entries`."""
+        with self._lock:
+            try:
+                names = [n for n in os.listdir(self.cache_dir) if n.endswith(".json")]
+            except FileNotFoundError:
+                return
+
+            entries = []
+            now = time.time()
+            for name in names:
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    mtime = os.path.getmtime(path)
+                    if now - mtime > self.max_age:
+                        os.remove(path)
+                    else:
+                        entries.append((mtime, path))
+                except FileNotFoundError:
+                    continue
+
+            entries.sort()
+            for _, path in entries[:max(0, len(entries) - self.max_entries)]:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def summary(self) -> str:
+        """Returns a one-line description of the hit/miss counters."""
+        return f"Prompt cache: {self.hits} hit(s), {self.misses} miss(es)"
+
+
+prompt_cache: Optional[PromptCache] = None
+"""Cache used by `send_prompts`, or None to always call the API."""
+
+
+DOWNLOAD_TIMEOUT = (10, 60)
+"""Connect and read timeouts (in seconds) for downloading generated panels."""
+
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+"""Number of bytes to read at a time when streaming a panel to disk."""
+
+
+DOWNLOAD_TRIES = 3
+"""Attempts to stream each panel before giving up, if the connection fails part way through."""
+
+
+_http_session: Optional[requests.Session] = None
+_http_session_lock = threading.Lock()
+
+
+def get_http_session() -> requests.Session:
+    """
+    Returns the HTTP session shared by all panel downloads, creating it on
+    first use.
+
+    The session pools connections (so concurrent panels reuse them) and
+    retries transient failures with exponential backoff.
+    """
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            retry = Retry(
+                total=5,
+                backoff_factor=0.5,
+                status_forcelist=[429, 500, 502, 503, 504],
+                allowed_methods=["GET"],
+            )
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry)
+
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _http_session = session
+
+        return _http_session
+
+
+def download_panel(image_url: str, file_name: str):
+    """
+    Streams the image at `image_url` to `file_name`.
+
+    The image is written in chunks to a temp file that is renamed into place
+    once complete, so an interrupted download never leaves a truncated panel.
+    The session only retries failures before the body starts, so if the
+    connection drops while streaming, the partial file is discarded and the
+    download starts again, up to `DOWNLOAD_TRIES` times.
+
+    Raises:
+        requests.HTTPError: If the server responds with an error status.
+        requests.RequestException: If every attempt failed.
+    """
+    temp_name = f"{file_name}.part"
+    try:
+        with tracer.span("download", bytes=0, retries=0) as span:
+            for attempt in range(1, DOWNLOAD_TRIES + 1):
+                try:
+                    span["bytes"] = 0
+                    with get_http_session().get(image_url, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+                        response.raise_for_status()
+                        with open(temp_name, "wb") as file:
+                            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                                file.write(chunk)
+                                span["bytes"] += len(chunk)
+                    break
+                except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                    if attempt == DOWNLOAD_TRIES:
+                        raise
+                    print(f"Download of {image_url} failed on attempt {attempt}/{DOWNLOAD_TRIES}: {e}")
+                    span["retries"] += 1
+                    time.sleep(0.5 * 2 ** (attempt - 1))
+        os.replace(temp_name, file_name)
+    finally:
+        if os.path.exists(temp_name):
+            os.remove(temp_name)
+
+
+def save_panel_b64(b64_data: str, file_name: str):
+    """
+    Decodes a base64 image returned directly by the API and writes it to
+    `file_name`, using the same temp file and rename as `download_panel`.
+    """
+    temp_name = f"{file_name}.part"
+    try:
+        with tracer.span("decode_b64") as span:
+            data = base64.b64decode(b64_data)
+            span["bytes"] = len(data)
+            with open(temp_name, "wb") as file:
+                file.write(data)
+        os.replace(temp_name, file_name)
+    finally:
+        if os.path.exists(temp_name):
+            os.remove(temp_name)
+
+
+MAX_TRIES = 5
+"""Default number of attempts to generate each panel before giving up."""
+
+
+class RetryPolicy:
+    """
+    Decides whether and how long to wait before retrying a failed image
+    generation request.
+
+    Waits use exponential backoff with full jitter, so parallel panels don't
+    retry in lockstep. Rate limit errors wait for at least as long as the
+    API's `Retry-After` header asks. A single policy is shared by every panel
+    in a strip, and once its deadline passes no further retries are made.
+    """
+
+    def __init__(
+        self,
+        max_tries: int = MAX_TRIES,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0,
+        deadline: Optional[float] = None,
+    ):
+        """
+        Args:
+            max_tries (int, optional): Attempts per panel before giving up. Defaults to `MAX_TRIES`.
+            base_delay (float, optional): Backoff (in seconds) before the first retry. Defaults to 1.0.
+            max_delay (float, optional): Longest backoff (in seconds) between retries. Defaults to 60.0.
+            deadline (Optional[float], optional): Seconds from now after which
+                no more retries are made. Defaults to None (no deadline).
+        """
+        self.max_tries = max_tries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = None if deadline is None else time.monotonic() + deadline
+
+    @staticmethod
+    def is_content_policy_error(error: Exception) -> bool:
+        """Returns True if the request was rejected by the content policy."""
+        return isinstance(error, openai.BadRequestError) and (
+            getattr(error, "code", None) == "content_policy_violation"
+            or "content_policy_violation" in str(error)
+        )
+
+    @staticmethod
+    def is_transient_error(error: Exception) -> bool:
+        """Returns True if the same request may succeed if sent again."""
+        return isinstance(error, (
+            openai.RateLimitError,
+            openai.APITimeoutError,
+            openai.APIConnectionError,
+            openai.InternalServerError,
+        ))
+
+    @staticmethod
+    def retry_after(error: Exception) -> Optional[float]:
+        """Returns the wait (in seconds) requested by the error's `Retry-After` header, if any."""
+        response = getattr(error, "response", None)
+        if response is None:
+            return None
+
+        value = response.headers.get("retry-after")
+        if value is None:
+            return None
+
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            return None
+
+    def delay(self, attempt: int, error: Exception) -> float:
+        """Returns how long to wait after the given (1-based) failed attempt."""
+        backoff = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+        if isinstance(error, openai.RateLimitError):
+            retry_after = self.retry_after(error)
+            if retry_after is not None:
+                return max(retry_after, backoff)
+
+        return backoff
+
+    def remaining(self) -> Optional[float]:
+        """Returns the seconds left before the deadline, or None if there is no deadline."""
+        if self.deadline is None:
+            return None
+        return self.deadline - time.monotonic()
+
+    def expired(self) -> bool:
+        """Returns True if the deadline has passed, so nothing more should be retried."""
+        remaining = self.remaining()
+        return remaining is not None and remaining <= 0
+
+    def wait(self, attempt: int, error: Exception) -> bool:
+        """
+        Sleeps before retrying after the given failed attempt.
+
+        Returns: False, without sleeping, if the wait would run past the
+        deadline and the caller should give up.
+        """
+        delay = self.delay(attempt, error)
+        remaining = self.remaining()
+        if remaining is not None and delay >= remaining:
+            return False
+
+        time.sleep(delay)
+        return True
+
+
+def rewrite_prompt(client: OpenAI, prompt: str) -> str:
+    """
+    Rewrites an image prompt that was rejected by the content policy so that
+    it can be sent again.
+    """
+    system = """
+    The following description of a comic panel was rejected by an image
+    generator's content policy. Rewrite it so that it is acceptable, keeping
+    the characters' appearances, expressions and the setting as close to the
+    original as possible. Only remove or soften what is necessary.
+
+    Respond with only the rewritten description.
+    """
+
+    return send_prompts(client, prompt, system=system)
+
+
+def describe_panels(client: OpenAI, dialog_lines: List[str], speakers: List[str]) -> Dict[int, str]:
+    """
+    Describes every panel of the strip with a single structured request.
+
+    This replaces the per-speaker and name-scrubbing requests made by
+    `describe_panel`, turning up to nine serial round-trips into one.
+
+    Args:
+        client (OpenAI): The OpenAI client instance.
+        dialog_lines (List[str]): All six lines of dialog for the comic.
+        speakers (List[str]): The normalized speaker for each line of dialog.
+
+    Returns:
+        Dict[int, str]: The name-free scene description for each panel, keyed
+        by 1-based panel ID.
+
+    Raises:
+        ValueError: If the response isn't valid JSON or is missing a panel.
+    """
+    system = """
+    You will be given the script for a three panel comic as JSON. Each panel
+    has one or two lines of dialog, and each character has a description of
+    their appearance.
+
+    For each panel, write a few sentences describing the scene: the
+    appearance of each character that speaks in that panel, along with their
+    facial expression and body language based on their dialog. Keep the
+    descriptions concise. Do not use the characters' names, only refer to the
+    characters by description.
+
+    Respond with JSON in the following format:
+    ```
+    {"panels": [{"panel": 1, "description": "..."}, ...]}
+    ```
+    """
+
+    script = {"characters": {}, "panels": []}
+    for i in range(3):
+        lines = []
+        for line in (2 * i, 2 * i + 1):
+            speaker = speakers[line]
+            script["characters"][speaker] = CHARACTERS[speaker]
+            lines.append(dialog_lines[line])
+        script["panels"].append({"panel": i + 1, "dialog": lines})
+
+    with tracer.span("describe_panels"):
+        response = send_prompts(client, json.dumps(script, indent=4), system=system, json_mode=True)
+
+    try:
+        panels = json.loads(response)["panels"]
+        descriptions = {int(panel["panel"]): str(panel["description"]) for panel in panels}
+    except (ValueError, KeyError, TypeError) as e:
+        raise ValueError(f"Malformed panel descriptions: {e}") from e
+
+    missing = [p for p in (1, 2, 3) if not descriptions.get(p)]
+    if missing:
+        raise ValueError(f"Panel descriptions missing for panel(s) {missing}")
+
+    return descriptions
+
+
+def describe_panel(client: OpenAI, p: int, dialog_lines: List[str], speakers: List[str]) -> str:
+    """
+    Describes a single panel, with one request per speaker followed by a
+    request to remove the character names from the description.
+
+    This is the fallback for when `describe_panels` fails.
+    """
+    i = p - 1
 
     panel_speakers = [speakers[2 * i], speakers[2 * i + 1]]
     panel_dialog = [dialog_lines[2 * i], dialog_lines[2 * i + 1]]
@@ -137,39 +734,68 @@ def generate_panel(client: OpenAI, p: int, dialog_lines: List[str], speakers: Li
     characters by description.
     """
 
-    simplified_descriptions = send_prompts(
-        client, verbose_descriptions, system=system)
+    return send_prompts(client, verbose_descriptions, system=system)
+
+
+def panel_prompt(description: str, location: str) -> str:
+    """Returns the image prompt for a panel with the given description and location."""
+    location_description = LOCATIONS[location]
 
     # Append location information.
-    final_description = f"""
-    {simplified_descriptions}
+    return f"""
+    {description}
 
     They stand in {location_description}
     """
 
-    # Draw the panel.
-    # ---------------
 
-    print(f"Final panel {p} prompt:", final_description)
+def request_panel_image(
+    client: OpenAI,
+    p: int,
+    prompt: str,
+    retry_policy: Optional[RetryPolicy] = None,
+    b64: bool = False,
+):
+    """
+    Generates the image for a panel, rewriting the prompt after content
+    policy violations and backing off after transient errors.
+
+    Returns: A tuple of (image URL, base64 image data), only one of which is set.
+    """
+    if retry_policy is None:
+        retry_policy = RetryPolicy()
+    max_tries = retry_policy.max_tries
+
+    print(f"Final panel {p} prompt:", prompt)
+
+    # The policy decides every retry, so turn off the client's own retries,
+    # which would otherwise make each attempt up to three requests.
+    images = client.with_options(max_retries=0).images
 
-    # Try to generate the image with retry logic for content policy violations
-    image_url = None
     for attempt in range(1, max_tries + 1):
         try:
             print(f"Attempting to generate panel {p} (attempt {attempt}/{max_tries})")
 
-            response = client.images.generate(
-                model="dall-e-3",
-                prompt=final_description,
-                size="1024x1792",
-                quality="hd",
-                style="vivid",
-                n=1,
-            )
+            # Only the attempts after the first are counted, so that the
+            # summed `retries` is the number of retries, however many there are.
+            with tracer.span("image_generate", panel=p, retries=int(attempt > 1)):
+                response = images.generate(
+                    model="dall-e-3",
+                    prompt=prompt,
+                    size="1024x1792",
+                    quality="hd",
+                    style="vivid",
+                    n=1,
+                    response_format="b64_json" if b64 else "url",
+                )
+
+            if b64:
+                print(f"\nPanel {p} received as base64")
+                return None, response.data[0].b64_json
 
             image_url = response.data[0].url
             print(f"\nPanel {p} URL: {image_url}")
-            break  # Success, exit the retry loop
+            return image_url, None
 
         except Exception as e:
             print(f"Panel {p} generation failed on attempt {attempt}/{max_tries}: {e}")
@@ -178,16 +804,146 @@ def generate_panel(client: OpenAI, p: int, dialog_lines: List[str], speakers: Li
                 print(f"Failed to generate panel {p} after {max_tries} attempts. Giving up.")
                 raise  # Re-raise the exception after all attempts are exhausted
 
-    # Download the panel.
-    if image_url:
-        response = requests.get(image_url)
-        file_name = f"panel_{p}.png"
-        with open(file_name, "wb") as file:
-            file.write(response.content)
+            if retry_policy.expired():
+                print(f"Deadline reached while generating panel {p}. Giving up.")
+                raise
+
+            if RetryPolicy.is_content_policy_error(e):
+                # Sending the same prompt again will most likely be rejected
+                # again, so rewrite it instead of waiting.
+                with tracer.span("prompt_rewrite", panel=p):
+                    prompt = rewrite_prompt(client, prompt)
+                print(f"Rewrote panel {p} prompt:", prompt)
+            elif RetryPolicy.is_transient_error(e):
+                with tracer.span("retry_wait", panel=p):
+                    waited = retry_policy.wait(attempt, e)
+                if not waited:
+                    print(f"Deadline reached while generating panel {p}. Giving up.")
+                    raise
+            else:
+                raise
+
+    raise RuntimeError(f"Failed to generate panel {p}: no image obtained")
 
-        print(f"Saved file to {file_name}")
+
+def save_panel_image(p: int, image_url: Optional[str], image_b64: Optional[str], file_name: str):
+    """Saves a generated panel to `file_name`, downloading it if needed."""
+    if image_b64:
+        save_panel_b64(image_b64, file_name)
+    elif image_url:
+        download_panel(image_url, file_name)
     else:
-        raise RuntimeError(f"Failed to generate panel {p}: no image URL obtained")
+        raise RuntimeError(f"Failed to generate panel {p}: no image obtained")
+
+    print(f"Saved file to {file_name}")
+
+
+def generate_panel(
+    client: OpenAI,
+    p: int,
+    dialog_lines: List[str],
+    speakers: List[str],
+    location: str,
+    retry_policy: Optional[RetryPolicy] = None,
+    description: Optional[str] = None,
+    b64: bool = False,
+    output_dir: str = ".",
+):
+    # Describe the panel, unless that's already been done for the whole strip.
+    if description is None:
+        description = describe_panel(client, p, dialog_lines, speakers)
+
+    # Draw the panel.
+    # ---------------
+
+    image_url, image_b64 = request_panel_image(
+        client, p, panel_prompt(description, location), retry_policy, b64)
+
+    # Download the panel.
+    save_panel_image(p, image_url, image_b64, os.path.join(output_dir, f"panel_{p}.png"))
+
+
+def generate_panels(
+    client: OpenAI,
+    panel_ids: List[int],
+    dialog_lines: List[str],
+    speakers: List[str],
+    location: str,
+    max_tries: int = MAX_TRIES,
+    concurrency: int = 3,
+    batch_prompts: bool = True,
+    b64: bool = False,
+    deadline: Optional[float] = None,
+    output_dir: str = ".",
+) -> Dict[int, Exception]:
+    """
+    Generates several panels, running up to `concurrency` of them at once.
+
+    Panels don't depend on each other, so each one runs in its own worker
+    thread (the OpenAI client is safe to share between threads). A failure in
+    one panel doesn't cancel the others; every panel is given the chance to
+    finish, and the failures are collected and returned.
+
+    Args:
+        client (OpenAI): The OpenAI client instance, shared by all workers.
+        panel_ids (List[int]): The 1-based IDs of the panels to generate.
+        dialog_lines (List[str]): All six lines of dialog for the comic.
+        speakers (List[str]): The normalized speaker for each line of dialog.
+        location (str): The key of the location to use for every panel.
+        max_tries (int, optional): Attempts per panel before giving up. Defaults to `MAX_TRIES`.
+        concurrency (int, optional): Maximum number of panels to generate at once. Defaults to 3.
+        batch_prompts (bool, optional): Describe all panels with one request
+            rather than several per panel. Falls back to the per-panel
+            requests if the batched one fails. Defaults to True.
+        b64 (bool, optional): Have the API return the images inline as
+            base64 instead of as a URL to download. Defaults to False.
+        deadline (Optional[float], optional): Seconds after which no panel is
+            retried again. Defaults to None (no deadline).
+        output_dir (str, optional): Directory to save the panels in. Defaults
+            to the current directory.
+
+    Returns:
+        Dict[int, Exception]: The exception raised for each panel that failed,
+        keyed by panel ID. Empty if every panel succeeded.
+    """
+    failures: Dict[int, Exception] = {}
+    retry_policy = RetryPolicy(max_tries=max_tries, deadline=deadline)
+
+    descriptions: Dict[int, str] = {}
+    if batch_prompts:
+        try:
+            descriptions = describe_panels(client, dialog_lines, speakers)
+        except Exception as e:
+            print(f"Batched panel descriptions failed, describing panels individually: {e}")
+
+    # Run sequentially when concurrency is disabled, which keeps the output
+    # readable when debugging a single panel.
+    if concurrency <= 1 or len(panel_ids) <= 1:
+        for panel_id in panel_ids:
+            try:
+                generate_panel(
+                    client, panel_id, dialog_lines, speakers, location, retry_policy, descriptions.get(panel_id), b64,
+                    output_dir)
+            except Exception as e:
+                failures[panel_id] = e
+        return failures
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {
+            executor.submit(
+                generate_panel, client, panel_id, dialog_lines, speakers, location, retry_policy,
+                descriptions.get(panel_id), b64, output_dir): panel_id
+            for panel_id in panel_ids
+        }
+
+        for future in as_completed(futures):
+            panel_id = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                failures[panel_id] = e
+
+    return failures
 
 
 def send_prompts(
@@ -195,6 +951,7 @@ def send_prompts(
     messages: Union[str, List[str]],
     system: Optional[str] = None,
     model: str = "gpt-4o",
+    json_mode: bool = False,
 ) -> str:
     """
     Sends prompts to an OpenAI chat completion API and returns the response.
@@ -204,6 +961,7 @@ def send_prompts(
         messages (Union[str, List[str]]): A string or a list of strings representing user messages.
         system (Optional[str], optional): Optional system message to include at the beginning. Defaults to None.
         model (str, optional): The model name to use for generating the completion. Defaults to "gpt-4o".
+        json_mode (bool, optional): Require the response to be a JSON object. Defaults to False.
 
     Returns:
         str: The response content from the OpenAI API.
@@ -230,330 +988,886 @@ def send_prompts(
     # Add user messages to prompts.
     prompts.extend({"role": "user", "content": m} for m in messages)
 
+    # Skip the round-trip entirely if we've already sent this exact request.
+    cache_key = None
+    if prompt_cache is not None:
+        cache_key = PromptCache.key(model, system, messages, json_mode)
+        with tracer.span("prompt_cache") as span:
+            cached = prompt_cache.get(cache_key)
+            span["hits"] = int(cached is not None)
+
+        if cached is not None:
+            if verbose:
+                print("Cached response:", cached)
+            return cached
+
     # Debug: print the prompts.
-    print("Sending prompts:", json.dumps(prompts, indent=4))
+    if verbose:
+        print("Sending prompts:", json.dumps(prompts, indent=4))
 
     # Send the prompts to OpenAI API.
-    completion = client.chat.completions.create(
-        model=model,
-        messages=prompts
-    )
+    with tracer.span("llm", model=model) as span:
+        if json_mode:
+            completion = client.chat.completions.create(
+                model=model,
+                messages=prompts,
+                response_format={"type": "json_object"},
+            )
+        else:
+            completion = client.chat.completions.create(
+                model=model,
+                messages=prompts
+            )
+
+        usage = getattr(completion, "usage", None)
+        if usage is not None:
+            span["prompt_tokens"] = usage.prompt_tokens
+            span["completion_tokens"] = usage.completion_tokens
 
     # Extract and return the response content.
     response = completion.choices[0].message.content
-    print("Response:", response)
+    if verbose:
+        print("Response:", response)
 
     if response is None:
         raise ValueError("OpenAI API returned empty response")
-    
+
+    if prompt_cache is not None and cache_key is not None:
+        prompt_cache.put(cache_key, response)
+
     return response
 
 
-def construct_comic(dialog_lines, rotate_panels=None, panel_shifts=None, panel_flips=None):
+PANEL_TRANSPOSES = {
+    (None, 0): None,
+    (None, 1): Image.Transpose.ROTATE_270,
+    (None, 2): Image.Transpose.ROTATE_180,
+    (None, 3): Image.Transpose.ROTATE_90,
+    ('h', 0): Image.Transpose.FLIP_LEFT_RIGHT,
+    ('h', 1): Image.Transpose.TRANSVERSE,
+    ('h', 2): Image.Transpose.FLIP_TOP_BOTTOM,
+    ('h', 3): Image.Transpose.TRANSPOSE,
+    ('v', 0): Image.Transpose.FLIP_TOP_BOTTOM,
+    ('v', 1): Image.Transpose.TRANSPOSE,
+    ('v', 2): Image.Transpose.FLIP_LEFT_RIGHT,
+    ('v', 3): Image.Transpose.TRANSVERSE,
+}
+"""
+The single transpose equivalent to flipping a panel (None, 'h' or 'v') and
+then rotating it clockwise by 90 degrees some number of times.
+"""
+
+
+def transform_panel(
+    source: Image.Image,
+    flip: Optional[str] = None,
+    shift: int = 0,
+    rotations: int = 0,
+    scale: float = 1.0,
+    source_scale: float = 1.0,
+) -> Image.Image:
     """
-    Constructs the final comic from the generated panels and parsed chat logs.
+    Flips, crops to a square, rotates and scales a panel as needed.
+
+    The result is the same as flipping the whole image, then cropping and
+    rotating it, but the crop is taken from the source first, so the flip
+    and rotation only ever touch the cropped square and are combined into
+    one transpose. When scaling, the crop and resize are also done together.
 
     Args:
-        dialog_lines: List of dialog lines for the comic
-        rotate_panels: List of panel numbers (1-based) to rotate 90 degrees clockwise
-        panel_shifts: List of tuples (panel_id, offset) for shifting crop positions
-        panel_flips: List of tuples (panel_id, direction) for flipping panels ('h' or 'v')
+        source: The decoded panel image.
+        flip: 'h' or 'v' to flip the panel horizontally or vertically.
+        shift: Offset in pixels to move the crop box by. Positive values move it down.
+        rotations: Number of times to rotate the panel 90 degrees clockwise.
+        scale: Amount to scale the panel by.
+        source_scale: Amount `source` has already been scaled by, relative to
+            the generated panel.
     """
-    if rotate_panels is None:
-        rotate_panels = []
-    if panel_shifts is None:
-        panel_shifts = []
-    if panel_flips is None:
-        panel_flips = []
+    width = round(source.width / source_scale)
+    height = round(source.height / source_scale)
 
-    # Combine the 3 panels into a single image.
-    # -----------------------------------------
-
-    # Load images for each panel.
-    panels: List[Image.Image] = [Image.open('panel_1.png'), Image.open('panel_2.png'), Image.open('panel_3.png')]
+    # Crop the images to 1024x1024 pixels if they are portrait (1024x1792).
+    box = (0, 0, width, height)
+    if (width, height) == (1024, 1792):
+        # Clamp the crop box to stay within image bounds
+        y_start = max(0, min(200 + shift, 1792 - 1024))
+        y_end = y_start + 1024
+
+        # The crop box is positioned on the flipped image, so mirror it
+        # when cropping the unflipped source.
+        if flip == 'v':
+            y_start, y_end = 1792 - y_end, 1792 - y_start
+
+        box = (0, y_start, 1024, y_end)
+
+    if scale != source_scale:
+        size = (round((box[2] - box[0]) * scale), round((box[3] - box[1]) * scale))
+        source_box = tuple(v * source_scale for v in box)
+        panel = source.resize(size, Image.Resampling.LANCZOS, box=source_box)
+    else:
+        panel = source.crop(tuple(round(v * source_scale) for v in box))
+        panel.load()
 
-    # Apply flips to specified panels (before cropping and shifting).
-    # --------------------------------------------------------------
-    
-    # Create a dictionary for quick lookup of panel flips
-    flip_dict = {}
-    for panel_id, direction in panel_flips:
-        panel_id = int(panel_id)  # Convert to int in case it's a string
-        flip_dict[panel_id] = direction
+    transpose = PANEL_TRANSPOSES[(flip, rotations % 4)]
+    if transpose is not None:
+        panel = panel.transpose(transpose)
 
-    # Apply flips to panels
-    for panel_id, direction in flip_dict.items():
-        panel_index = panel_id - 1  # Convert to 0-based index
-        if direction == 'h':
-            panels[panel_index] = panels[panel_index].transpose(Image.Transpose.FLIP_LEFT_RIGHT)
-        elif direction == 'v':
-            panels[panel_index] = panels[panel_index].transpose(Image.Transpose.FLIP_TOP_BOTTOM)
+    return panel
 
-    # Create a dictionary for quick lookup of panel shifts
-    shift_dict = {panel_id: offset for panel_id, offset in panel_shifts}
 
-    # Crop the images to 1024x1024 pixels if they are portrait (1024x1792).
-    default_crop_box = (0, 200, 1024, 200 + 1024)
-    for index, panel in enumerate(panels):
-        if panel.size == (1024, 1792):
-            panel_id = index + 1  # Convert to 1-based panel ID
+def load_panel(file_name: str) -> Image.Image:
+    """Loads and decodes a generated panel."""
+    with tracer.span("panel_decode"), Image.open(file_name) as source:
+        if source.mode not in ('RGB', 'RGBA'):
+            return source.convert('RGB')
 
-            # Check if this panel has a shift offset and apply it if so.
-            if panel_id in shift_dict:
-                shift_offset = shift_dict[panel_id]
+        source.load()
+        return source.copy()
 
-                y_start = 200 + shift_offset
-                y_end = y_start + 1024
 
-                # Clamp the crop box to stay within image bounds
-                y_start = max(0, min(y_start, 1792 - 1024))
-                y_end = y_start + 1024
+@lru_cache(maxsize=None)
+def load_font(file_name: str, size: int) -> ImageFont.FreeTypeFont:
+    """
+    Loads a font, reusing it if it has already been loaded at this size.
+    Sharing fonts also lets `segment_width` reuse measurements across comics.
+    """
+    return ImageFont.truetype(file_name, size)
 
-                crop_box = (0, y_start, 1024, y_end)
-            else:
-                crop_box = default_crop_box
 
-            panels[index] = panel.crop(crop_box)
+class ComicRenderer:
+    """
+    Draws comic strips at a fixed scale.
+
+    The fonts and the layout of the dialog are worked out once, when the
+    renderer is created, and the dialog is drawn once, the first time a strip
+    is drawn. Both are reused for every strip it draws. Panels are
+    loaded from the `panel_N.png` files as they're drawn and then released,
+    unless a decoded source has been given with `set_source`. In that case
+    each transformed panel is also cached, so redrawing the strip after
+    changing one panel's settings only re-transforms that panel.
+    """
 
-    # Rotate specified panels 90 degrees clockwise (after cropping).
-    for panel_number in rotate_panels:
-        panel_index = panel_number - 1  # Convert to 0-based index
-        panels[panel_index] = panels[panel_index].rotate(-90, expand=True)
+    PANEL_WIDTH = 1024
+    """Width of each (square) panel, in full-size pixels."""
 
-    # Define the dimensions of the comic.
-    panel_width = 1024
-    padding = 25
+    PADDING = 25
+    """Space around and between the panels, in full-size pixels."""
 
-    # Calculate the width and height of the final image
-    total_width = panel_width * 3 + padding * 4
-    total_height = panel_width + padding * 2
+    def __init__(self, dialog_lines: List[str], scale: float = 1.0, panel_dir: str = "."):
+        """
+        Args:
+            dialog_lines: List of dialog lines for the comic
+            scale: Size to draw the comic at, relative to the generated panels.
+            panel_dir: Directory containing the `panel_N.png` files.
+        """
+        self.scale = scale
+        self.panel_dir = panel_dir
+        self.sources: Dict[int, tuple] = {}
+        self.panel_cache: Dict[tuple, Image.Image] = {}
+        self.text_overlay: Optional[Image.Image] = None
+
+        # Calculate the width and height of the final image
+        self.total_width = self.PANEL_WIDTH * 3 + self.PADDING * 4
+        self.total_height = self.PANEL_WIDTH + self.PADDING * 2
+
+        # Setup fonts and wrap lines of dialog within a max width.
+        self.regular_font = load_font(REGULAR_FONT_FILE, round(38 * scale))
+        self.emoji_font = load_font(EMOJI_FONT_FILE, round(38 * scale))
+        with tracer.span("text_layout"):
+            self.layouts = [
+                layout_mixed_text(line, self.regular_font, self.emoji_font, 900 * scale, line_spacing=5 * scale)
+                for line in dialog_lines
+            ]
+
+    def set_source(self, panel_id: int, source: Image.Image, source_scale: float = 1.0):
+        """Keeps a decoded panel in memory to draw from instead of its file."""
+        self.sources[panel_id] = (source, source_scale)
+        self.panel_cache = {key: panel for key, panel in self.panel_cache.items() if key[0] != panel_id}
+
+    def panel(self, panel_id: int, flip: Optional[str], shift: int, rotations: int) -> Image.Image:
+        """Returns the transformed panel, ready to paste into the strip."""
+        if panel_id not in self.sources:
+            with load_panel(os.path.join(self.panel_dir, f"panel_{panel_id}.png")) as source:
+                with tracer.span("panel_transform"):
+                    return transform_panel(source, flip, shift, rotations, self.scale)
+
+        key = (panel_id, flip, shift, rotations % 4)
+        if key not in self.panel_cache:
+            # Only keep the most recent settings for each panel.
+            self.panel_cache = {k: v for k, v in self.panel_cache.items() if k[0] != panel_id}
+
+            source, source_scale = self.sources[panel_id]
+            with tracer.span("panel_transform"):
+                self.panel_cache[key] = transform_panel(source, flip, shift, rotations, self.scale, source_scale)
+
+        return self.panel_cache[key]
+
+    def draw_text_overlay(self) -> Image.Image:
+        """
+        Draws the dialog text boxes onto a transparent image the size of the
+        strip. The dialog never changes, so this is only done once and then
+        pasted over the panels every time the strip is drawn.
+        """
+        scale = self.scale
+        panel_width = self.PANEL_WIDTH
+        padding = self.PADDING
 
-    # Create a new blank image with a white background.
-    comic = Image.new('RGB', (total_width, total_height), (255, 255, 255))
+        overlay = Image.new(
+            'RGBA', (round(self.total_width * scale), round(self.total_height * scale)), (255, 255, 255, 0))
+        draw = ImageDraw.Draw(overlay)
 
-    # Paste the images into the new image with the appropriate padding
-    for index, panel in enumerate(panels):
-        offset = panel_width * index + padding * (index + 1)
-        comic.paste(panel, (offset, padding))
+        # Iterate over the panels and add the dialog.
+        for i in range(3):
+            first_layout = self.layouts[2 * i]
+            second_layout = self.layouts[2 * i + 1]
 
-    # Add lines of dialog to the comic.
-    # ---------------------------------
+            # Calculate anchors for the text boxes.
+            left_edge = (i * panel_width + padding * (i + 1)) * scale
+            right_edge = left_edge + panel_width * scale
 
-    # Setup comic for having text drawn into it.
-    regular_font = ImageFont.truetype("FiraCode-Bold.ttf", 38)
-    emoji_font = ImageFont.truetype("NotoEmoji.ttf", 38)
-    draw = ImageDraw.Draw(comic)
+            # Draw the first text box (left-aligned).
+            first_line_position = (left_edge, padding * scale)
+            _, first_text_height = draw_mixed_text_box(
+                draw, first_layout, first_line_position, padding=10 * scale)
 
-    # Iterate over the panels and add the dialog.
-    for i in range(3):
-        first_line = dialog_lines[2 * i]
-        second_line = dialog_lines[2 * i + 1]
+            # Draw the second text box (right-aligned).
+            second_line_position = (
+                right_edge - second_layout.width, first_line_position[1] + first_text_height + padding * scale)
+            draw_mixed_text_box(draw, second_layout, second_line_position, padding=10 * scale)
 
-        # Wrap lines of dialog within a max width.
-        first_line_wrapped = wrap_mixed_text(first_line, regular_font, emoji_font, 900, draw)
-        second_line_wrapped = wrap_mixed_text(second_line, regular_font, emoji_font, 900, draw)
+        return overlay
 
-        # Calculate anchors for the text boxes.
-        left_edge = i * panel_width + padding * (i + 1)
-        right_edge = left_edge + panel_width
+    def render(self, flips: Dict[int, str], shifts: Dict[int, int], rotations: Dict[int, int]) -> Image.Image:
+        """
+        Draws the strip.
 
-        # Draw the first text box (left-aligned).
-        first_line_position = (left_edge, padding)
-        _, first_text_height = draw_mixed_text_box(
-            draw, first_line_wrapped, regular_font, emoji_font, first_line_position, padding=10
-        )
+        Args:
+            flips: Direction ('h' or 'v') to flip each panel, keyed by panel ID.
+            shifts: Offset to shift each panel's crop by, keyed by panel ID.
+            rotations: Number of clockwise rotations for each panel, keyed by panel ID.
+        """
+        scale = self.scale
+        panel_width = self.PANEL_WIDTH
+        padding = self.PADDING
 
-        # Draw the second text box (right-aligned).
-        text_width, _ = get_mixed_multiline_text_bbox(second_line_wrapped, regular_font, emoji_font, draw)
-        second_line_position = (
-            right_edge - text_width, first_line_position[1] + first_text_height + padding)
-        draw_mixed_text_box(
-            draw, second_line_wrapped, regular_font, emoji_font, second_line_position, padding=10)
+        # Combine the 3 panels into a single image.
+        # -----------------------------------------
 
-    # Downscale the image by half and save it to disk.
-    comic = comic.resize((total_width // 2, total_height // 2))
-    comic.save('comic_strip.png')
+        # Create a new blank image with a white background.
+        comic = Image.new(
+            'RGB', (round(self.total_width * scale), round(self.total_height * scale)), (255, 255, 255))
 
+        # Paste each panel into the new image with the appropriate padding.
+        # Panels loaded from disk are released once pasted, so only one
+        # decoded panel is held in memory at once.
+        for index in range(3):
+            panel_id = index + 1
+            panel = self.panel(panel_id, flips.get(panel_id), shifts.get(panel_id, 0), rotations.get(panel_id, 0))
 
-def draw_mixed_text_box(draw, text_lines, regular_font, emoji_font, position, padding=0):
-    """
-    Draws text with mixed fonts on an image with a background rectangle.
+            offset = panel_width * index + padding * (index + 1)
+            with tracer.span("composite"):
+                comic.paste(panel, (round(offset * scale), round(padding * scale)))
+            if panel_id not in self.sources:
+                panel.close()
 
-    :param draw: ImageDraw object.
-    :param text_lines: List of text lines to draw.
-    :param regular_font: The regular font to use.
-    :param emoji_font: The emoji font to use.
-    :param position: Tuple (x, y) for the top-left position.
-    :param padding: Padding inside the rectangle.
-    :return: width and height of the drawn text box (including padding)
-    """
-    # Calculate the text bounding box.
-    text_width, text_height = get_mixed_multiline_text_bbox(text_lines, regular_font, emoji_font, draw)
+        # Add lines of dialog to the comic.
+        # ---------------------------------
 
-    # Adjust rectangle for padding.
-    rect_start = (position[0] - padding, position[1] - padding)
-    rect_end = (position[0] + text_width + padding,
-                position[1] + text_height + padding)
+        if self.text_overlay is None:
+            with tracer.span("text_draw"):
+                self.text_overlay = self.draw_text_overlay()
 
-    # Draw the text box and text.
-    draw.rectangle([rect_start, rect_end], fill=(255, 255, 255))
-    draw_mixed_multiline_text(draw, text_lines, regular_font, emoji_font, position, fill=(0, 0, 0))
+        with tracer.span("composite"):
+            comic.paste(self.text_overlay, (0, 0), self.text_overlay)
 
-    # Return the size of the text box including padding.
-    total_width = text_width + 2 * padding
-    total_height = text_height + 2 * padding
-    return total_width, total_height
+        return comic
+
+
+def panel_settings(rotate_panels=None, panel_shifts=None, panel_flips=None):
+    """
+    Converts the command line panel options into dicts of flips, shifts and
+    rotation counts keyed by panel ID, as taken by `ComicRenderer.render`.
+    """
+    # Create a dictionary for quick lookup of panel flips
+    flips = {}
+    for panel_id, direction in panel_flips or []:
+        panel_id = int(panel_id)  # Convert to int in case it's a string
+        flips[panel_id] = direction
+
+    # Create a dictionary for quick lookup of panel shifts
+    shifts = {panel_id: offset for panel_id, offset in panel_shifts or []}
+
+    rotations = {}
+    for panel_id in rotate_panels or []:
+        rotations[panel_id] = rotations.get(panel_id, 0) + 1
+
+    return flips, shifts, rotations
+
+
+def construct_comic(
+    dialog_lines, rotate_panels=None, panel_shifts=None, panel_flips=None, direct=True, output_dir=".",
+):
+    """
+    Constructs the final comic from the generated panels and parsed chat logs.
+
+    Args:
+        dialog_lines: List of dialog lines for the comic
+        rotate_panels: List of panel numbers (1-based) to rotate 90 degrees clockwise
+        panel_shifts: List of tuples (panel_id, offset) for shifting crop positions
+        panel_flips: List of tuples (panel_id, direction) for flipping panels ('h' or 'v')
+        direct: Draw the comic at its output size, downscaling each panel once.
+            If False, the comic is drawn at full size and then downscaled.
+        output_dir: Directory containing the panels, where comic_strip.png is saved.
+    """
+    # When drawing directly at the output size, everything is scaled down as
+    # it's drawn so that the full-size canvas never has to be allocated.
+    scale = OUTPUT_SCALE if direct else 1.0
+
+    with tracer.span("construct_comic"):
+        renderer = ComicRenderer(dialog_lines, scale, panel_dir=output_dir)
+        comic = renderer.render(*panel_settings(rotate_panels, panel_shifts, panel_flips))
+
+        # Downscale the image if it was drawn at full size, then save it to disk.
+        if scale == 1.0:
+            comic = comic.resize(
+                (round(renderer.total_width * OUTPUT_SCALE), round(renderer.total_height * OUTPUT_SCALE)))
+
+        encode_png(comic, os.path.join(output_dir, 'comic_strip.png'), png_profile)
+
+
+def palette_version(image: Image.Image, max_rms: float) -> Optional[Image.Image]:
+    """
+    Returns `image` reduced to a 256 color palette, if the result is within
+    `max_rms` of the original, or None. With `max_rms` of 0, only images with
+    256 colors or fewer are considered, and only an exact match is accepted.
+    """
+    if image.mode != 'RGB':
+        return None
+    if max_rms == 0 and image.getcolors(256) is None:
+        return None
+
+    quantized = image.quantize(256, dither=Image.Dither.NONE)
+    difference = ImageChops.difference(image, quantized.convert('RGB'))
+    if max_rms == 0:
+        return quantized if difference.getbbox() is None else None
+    return quantized if max(ImageStat.Stat(difference).rms) <= max_rms else None
+
+
+def encode_png(image: Image.Image, file_name: str, profile: str = "balanced") -> dict:
+    """
+    Encodes `image` as a PNG with the settings of `profile` from
+    `PNG_PROFILES`, and writes it to `file_name`.
+
+    Returns: A dict with the size of the file in "bytes", the time taken in
+    "seconds", and whether a "palette" was used.
+    """
+    settings = PNG_PROFILES[profile]
+    start = time.perf_counter()
+
+    with tracer.span("encode", profile=profile) as span:
+        buffer = io.BytesIO()
+        image.save(buffer, 'PNG', **settings["save"])
+        data = buffer.getvalue()
+
+        palette = None
+        if settings["palette"] is not None:
+            palette = palette_version(image, 0 if settings["palette"] == "exact" else PALETTE_MAX_RMS)
+        if palette is not None:
+            buffer = io.BytesIO()
+            palette.save(buffer, 'PNG', **settings["save"])
+            if len(buffer.getvalue()) < len(data):
+                data = buffer.getvalue()
+            else:
+                palette = None
+
+        with open(file_name, 'wb') as f:
+            f.write(data)
+        span["bytes"] = len(data)
+
+    return {"bytes": len(data), "seconds": time.perf_counter() - start, "palette": palette is not None}
+
+
+def recompress_png(file_name: str, profile: str = "max") -> dict:
+    """
+    Re-encodes the PNG `file_name` with `profile`, replacing it only if the
+    result is smaller.
+
+    Returns: The stats from `encode_png`, with the original size in
+    "old_bytes" and whether the file was "replaced".
+    """
+    with Image.open(file_name) as image:
+        image.load()
+
+    old_bytes = os.path.getsize(file_name)
+    temp_name = f"{file_name}.tmp"
+    try:
+        stats = encode_png(image, temp_name, profile)
+        stats["old_bytes"] = old_bytes
+        stats["replaced"] = stats["bytes"] < old_bytes
+        if stats["replaced"]:
+            os.replace(temp_name, file_name)
+    finally:
+        if os.path.exists(temp_name):
+            os.remove(temp_name)
+
+    return stats
+
+
+def recompress_archive(profile: str = "max", jobs: int = 2):
+    """Recompresses every published comic in place with `profile`, `jobs` at a time."""
+    comic_names = sorted(f for f in os.listdir(COMICS_DIR) if f.endswith('.png'))
+
+    old_total = new_total = 0
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {
+            executor.submit(recompress_png, os.path.join(COMICS_DIR, name), profile): name
+            for name in comic_names
+        }
+        for future in as_completed(futures):
+            stats = future.result()
+            new_bytes = stats["bytes"] if stats["replaced"] else stats["old_bytes"]
+            old_total += stats["old_bytes"]
+            new_total += new_bytes
+            print(
+                f"{futures[future]}: {stats['old_bytes']:,} -> {new_bytes:,} bytes in {stats['seconds']:.2f}s"
+                f"{' (palette)' if stats['palette'] and stats['replaced'] else ''}"
+                f"{'' if stats['replaced'] else ' (kept original)'}")
+
+    if comic_names:
+        print(f"Recompressed {len(comic_names)} comics: {old_total:,} -> {new_total:,} bytes "
+              f"({(old_total - new_total) / old_total:.1%} smaller)")
+
+
+PREVIEW_PAGE = """<!DOCTYPE html>
+<html>
+
+<head>
+  <title>Comic preview</title>
+  <style>
+    body { font-family: sans-serif; }
+    fieldset { display: inline-block; }
+    img { display: block; margin: 1em 0; }
+  </style>
+</head>
+
+<body>
+  <img id="preview" src="/preview.jpg">
+  <form id="settings"></form>
+  <button id="render">Render</button>
+  <pre id="status"></pre>
+
+  <script>
+    const settings = SETTINGS;
+    const form = document.getElementById('settings');
+
+    for (const id of [1, 2, 3]) {
+      form.insertAdjacentHTML('beforeend', `
+        <fieldset>
+          <legend>Panel ${id}</legend>
+          <label>Shift <input type="range" name="s${id}" min="-200" max="568" step="2" value="${settings.shifts[id] || 0}"></label>
+          <output id="s${id}-value">${settings.shifts[id] || 0}</output><br>
+          <label>Flip <select name="f${id}">
+            <option value="">none</option><option value="h">h</option><option value="v">v</option>
+          </select></label>
+          <label>Rotate <select name="r${id}">
+            <option value="0">0</option><option value="1">90</option><option value="2">180</option><option value="3">270</option>
+          </select></label>
+        </fieldset>`);
+      form.elements[`f${id}`].value = settings.flips[id] || '';
+      form.elements[`r${id}`].value = settings.rotations[id] || 0;
+    }
+
+    const query = () => new URLSearchParams(new FormData(form)).toString();
+
+    form.addEventListener('input', () => {
+      for (const id of [1, 2, 3]) {
+        document.getElementById(`s${id}-value`).textContent = form.elements[`s${id}`].value;
+      }
+      document.getElementById('preview').src = '/preview.jpg?' + query();
+    });
+
+    document.getElementById('render').addEventListener('click', () => {
+      fetch('/render?' + query(), { method: 'POST' })
+        .then(response => response.json())
+        .then(data => {
+          document.getElementById('status').textContent = `Saved ${data.file}\ncomic.py -c ${data.args}`;
+        });
+    });
+
+    document.getElementById('preview').src = '/preview.jpg?' + query();
+  </script>
+</body>
+
+</html>
+"""
+"""Page served by the preview server, with controls for each panel's settings."""
+
+
+def parse_preview_query(query: str):
+    """
+    Parses the panel settings sent by the preview page, returning dicts of
+    flips, shifts and rotation counts keyed by panel ID.
+    """
+    params = parse_qs(query)
+    flips, shifts, rotations = {}, {}, {}
+
+    for panel_id in (1, 2, 3):
+        flip = params.get(f"f{panel_id}", [""])[0]
+        if flip in ('h', 'v'):
+            flips[panel_id] = flip
+
+        try:
+            shifts[panel_id] = int(params.get(f"s{panel_id}", ["0"])[0])
+            rotations[panel_id] = int(params.get(f"r{panel_id}", ["0"])[0]) % 4
+        except ValueError:
+            pass
+
+    return flips, shifts, rotations
+
+
+def format_panel_args(flips: Dict[int, str], shifts: Dict[int, int], rotations: Dict[int, int]) -> str:
+    """Returns the command line options that reproduce the given panel settings."""
+    args = []
+    for panel_id, offset in sorted(shifts.items()):
+        if offset:
+            args.append(f"-s {panel_id} {offset}")
+    for panel_id, direction in sorted(flips.items()):
+        args.append(f"-f {panel_id} {direction}")
+
+    rotate = [str(panel_id) for panel_id, count in sorted(rotations.items()) for _ in range(count % 4)]
+    if rotate:
+        args.append(f"-r {' '.join(rotate)}")
+
+    return " ".join(args)
+
+
+def serve_preview(dialog_lines, port=8000, rotate_panels=None, panel_shifts=None, panel_flips=None, direct=True):
+    """
+    Serves a page for interactively tuning each panel's shift, flip and
+    rotation.
+
+    The panels are decoded once and kept in memory, along with the fonts and
+    the layout of the dialog, so each change only re-transforms the panel
+    that changed and draws a small preview. The full-quality comic is only
+    drawn (and saved to comic_strip.png) when requested.
+
+    Args:
+        dialog_lines: List of dialog lines for the comic
+        port: Port to serve the preview on.
+        rotate_panels: Initial list of panel numbers (1-based) to rotate 90 degrees clockwise
+        panel_shifts: Initial list of tuples (panel_id, offset) for shifting crop positions
+        panel_flips: Initial list of tuples (panel_id, direction) for flipping panels ('h' or 'v')
+        direct: Draw the final comic directly at its output size.
+    """
+    final_scale = OUTPUT_SCALE if direct else 1.0
+    final_renderer = ComicRenderer(dialog_lines, final_scale)
+    preview_renderer = ComicRenderer(dialog_lines, PREVIEW_SCALE)
+
+    # Decode each panel once, and keep a small copy of it for the previews.
+    for panel_id in (1, 2, 3):
+        source = load_panel(f"panel_{panel_id}.png")
+        final_renderer.set_source(panel_id, source)
+
+        preview_size = (round(source.width * PREVIEW_SCALE), round(source.height * PREVIEW_SCALE))
+        preview_renderer.set_source(
+            panel_id, source.resize(preview_size, Image.Resampling.LANCZOS), PREVIEW_SCALE)
+
+    flips, shifts, rotations = panel_settings(rotate_panels, panel_shifts, panel_flips)
+    page = PREVIEW_PAGE.replace(
+        "SETTINGS", json.dumps({"flips": flips, "shifts": shifts, "rotations": rotations}))
+
+    class PreviewHandler(BaseHTTPRequestHandler):
+        def send_body(self, body: bytes, content_type: str, headers: Optional[Dict[str, str]] = None):
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path == "/":
+                self.send_body(page.encode("utf-8"), "text/html; charset=utf-8")
+            elif url.path == "/preview.jpg":
+                # The server runs until it's stopped, so only keep the spans
+                # of the latest render rather than every one ever made.
+                tracer.reset()
+                start = time.perf_counter()
+                preview = preview_renderer.render(*parse_preview_query(url.query))
+
+                # Previews are encoded as JPEG, which is many times faster to
+                # encode than PNG.
+                buffer = io.BytesIO()
+                preview.save(buffer, format="JPEG", quality=85)
+                elapsed = (time.perf_counter() - start) * 1000
+
+                self.send_body(buffer.getvalue(), "image/jpeg", {
+                    "Cache-Control": "no-store",
+                    "Server-Timing": f"render;dur={elapsed:.1f}",
+                })
+            else:
+                self.send_error(404)
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            if url.path != "/render":
+                self.send_error(404)
+                return
+
+            tracer.reset()
+            settings = parse_preview_query(url.query)
+            comic = final_renderer.render(*settings)
+            if final_scale == 1.0:
+                comic = comic.resize((
+                    round(final_renderer.total_width * OUTPUT_SCALE),
+                    round(final_renderer.total_height * OUTPUT_SCALE),
+                ))
+            encode_png(comic, 'comic_strip.png', png_profile)
+
+            args = format_panel_args(*settings)
+            print(f"Saved comic_strip.png (comic.py -c {args})")
+            body = json.dumps({"file": "comic_strip.png", "args": args})
+            self.send_body(body.encode("utf-8"), "application/json")
+
+    server = HTTPServer(("127.0.0.1", port), PreviewHandler)
+    print(f"Serving preview on http://127.0.0.1:{port}/ (Ctrl+C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+EMOJI_CHARACTERS = ['\u2764', '\u2665', '\u2763']  # Common heart symbols
+"""Single characters that are always drawn as emoji."""
+
+
+EMOJI_RANGES = [
+    ('\U0001F600', '\U0001F64F'),  # Emoticons
+    ('\U0001F300', '\U0001F5FF'),  # Misc symbols
+    ('\U0001F680', '\U0001F6FF'),  # Transport symbols
+    ('\U0001F1E0', '\U0001F1FF'),  # Regional indicators (flags)
+    ('\U00002600', '\U000026FF'),  # Misc symbols
+    ('\U00002700', '\U000027BF'),  # Dingbats
+]
+"""
+Ranges of characters, inclusive, that are always drawn as emoji. Together
+with `EMOJI_CHARACTERS` and the other symbols (category So), these are the
+same rules as the original per-character check, kept in bench.py as
+`legacy_is_emoji`.
+"""
+
+
+@lru_cache(maxsize=None)
+def emoji_table() -> List[int]:
+    """
+    Returns the sorted boundaries of the code point ranges that are emoji.
+
+    Code points in `[table[2n], table[2n + 1])` are emoji, so a character can
+    be classified with a single bisect. The table covers exactly the code
+    points below U+20000 that are in category So, in `EMOJI_CHARACTERS` or
+    in `EMOJI_RANGES`, and is built on first use. No symbols exist beyond
+    the first two Unicode planes, so only those are scanned.
+    """
+    flags = bytearray(unicodedata.category(chr(code)) == 'So' for code in range(0x20000))
+    for char in EMOJI_CHARACTERS:
+        flags[ord(char)] = 1
+    for lo, hi in EMOJI_RANGES:
+        flags[ord(lo):ord(hi) + 1] = b"\x01" * (ord(hi) - ord(lo) + 1)
+
+    table = []
+    in_range = False
+    for code, emoji in enumerate(flags):
+        if emoji != in_range:
+            table.append(code)
+            in_range = bool(emoji)
+
+    if in_range:
+        table.append(0x20000)
+
+    return table
 
 
 def is_emoji(char):
     """
     Check if a character is an emoji.
     """
-    # Check for emoji characters using Unicode categories
-    return (
-        unicodedata.category(char) == 'So' or  # Other symbols (most emoji)
-        char in ['\u2764', '\u2665', '\u2763']  # Common heart symbols
-        or '\U0001F600' <= char <= '\U0001F64F'  # Emoticons
-        or '\U0001F300' <= char <= '\U0001F5FF'  # Misc symbols
-        or '\U0001F680' <= char <= '\U0001F6FF'  # Transport symbols
-        or '\U0001F1E0' <= char <= '\U0001F1FF'  # Regional indicators (flags)
-        or '\U00002600' <= char <= '\U000026FF'  # Misc symbols
-        or '\U00002700' <= char <= '\U000027BF'  # Dingbats
-    )
+    return bisect_right(emoji_table(), ord(char)) % 2 == 1
+
+
+@lru_cache(maxsize=None)
+def emoji_run_pattern() -> re.Pattern:
+    """
+    Returns a compiled pattern matching a run of one or more emoji clusters.
+
+    A cluster starts with an emoji, or any character followed by an emoji
+    presentation selector or keycap, and continues through any extenders (ZWJ,
+    variation selectors, skin tone modifiers, keycaps and tags) and characters
+    joined on with a ZWJ.
+    """
+    table = emoji_table()
+    base = "".join(
+        f"\\U{table[i]:08x}-\\U{table[i + 1] - 1:08x}" for i in range(0, len(table), 2))
+    extender = "\\u200d\\ufe00-\\ufe0f\\U0001f3fb-\\U0001f3ff\\u20e3\\U000e0020-\\U000e007f"
+    cluster = f"(?:[{base}]|.(?=[\\ufe0f\\u20e3]))(?:[{extender}]|(?<=\\u200d).)*"
+
+    # No ASCII character is an emoji on its own, so rule out plain text with a
+    # cheap check before trying the (much larger) set of emoji ranges.
+    guard = "(?=[^\\x00-\\x7f]|.[\\ufe0f\\u20e3])"
+    return re.compile(f"{guard}(?:{cluster})+", re.DOTALL)
 
 
 def split_text_by_font(text):
     """
     Split text into segments that need different fonts (regular text vs emoji).
     Returns a list of tuples: (text_segment, is_emoji)
+
+    Emoji sequences (ZWJ sequences, skin tones, variation selectors, keycaps
+    and tag sequences) are kept together as one cluster, so every character
+    in the sequence is drawn with the emoji font.
     """
     segments = []
-    current_segment = ""
-    current_is_emoji = None
+    end = 0
 
-    for char in text:
-        char_is_emoji = is_emoji(char)
+    for match in emoji_run_pattern().finditer(text):
+        if match.start() > end:
+            segments.append((text[end:match.start()], False))
+        segments.append((match.group(), True))
+        end = match.end()
 
-        if current_is_emoji is None:
-            current_is_emoji = char_is_emoji
-            current_segment = char
-        elif current_is_emoji == char_is_emoji:
-            current_segment += char
-        else:
-            # Font type changed, save current segment and start new one
-            if current_segment:
-                segments.append((current_segment, current_is_emoji))
-            current_segment = char
-            current_is_emoji = char_is_emoji
-
-    # Add the last segment
-    if current_segment:
-        segments.append((current_segment, current_is_emoji))
+    if end < len(text):
+        segments.append((text[end:], False))
 
     return segments
 
 
-def get_mixed_text_bbox(text, regular_font, emoji_font, draw):
+@lru_cache(maxsize=4096)
+def segment_width(font: ImageFont.FreeTypeFont, text: str) -> float:
+    """
+    Returns the advance width of `text` drawn in `font`.
+
+    Advance widths add up, so a line can be measured one word at a time and
+    each word only ever has to be measured once.
     """
-    Calculate the bounding box for text that may contain emoji.
+    return font.getlength(text)
+
+
+class TextLayout:
     """
-    segments = split_text_by_font(text)
-    total_width = 0
-    max_height = 0
+    Wrapped lines of mixed regular and emoji text, with the position of every
+    segment already worked out.
 
-    for segment_text, is_emoji in segments:
-        font = emoji_font if is_emoji else regular_font
-        bbox = draw.textbbox((0, 0), segment_text, font=font)
-        segment_width = bbox[2] - bbox[0]
-        segment_height = bbox[3] - bbox[1]
+    Building the layout does all of the measuring, so the same layout can be
+    used both to size the text box and to draw the text.
+    """
 
-        total_width += segment_width
-        max_height = max(max_height, segment_height)
+    def __init__(
+        self,
+        regular_font: ImageFont.FreeTypeFont,
+        emoji_font: ImageFont.FreeTypeFont,
+        line_spacing: float = 5,
+    ):
+        self.regular_font = regular_font
+        self.emoji_font = emoji_font
 
-    return total_width, max_height
+        # Use the larger font size for line spacing, plus some extra spacing.
+        self.line_height = max(regular_font.size, emoji_font.size) + line_spacing
 
+        self.lines: List[List[tuple]] = []
+        """Segments for each line, as (x offset, text, font) tuples."""
 
-def draw_mixed_text(draw, text, regular_font, emoji_font, position, fill=(0, 0, 0)):
-    """
-    Draw text with mixed fonts (regular text + emoji).
-    Returns the total width drawn.
-    """
-    segments = split_text_by_font(text)
-    x, y = position
-    total_width = 0
+        self.line_widths: List[float] = []
+        """Width of each line."""
 
-    for segment_text, is_emoji in segments:
-        font = emoji_font if is_emoji else regular_font
+    @property
+    def width(self) -> float:
+        return max(self.line_widths, default=0)
 
-        # Draw the segment
-        draw.text((x + total_width, y), segment_text, font=font, fill=fill)
+    @property
+    def height(self) -> float:
+        return len(self.lines) * self.line_height
 
-        # Calculate width for positioning next segment
-        bbox = draw.textbbox((0, 0), segment_text, font=font)
-        segment_width = bbox[2] - bbox[0]
-        total_width += segment_width
+    def font_for(self, is_emoji: bool) -> ImageFont.FreeTypeFont:
+        return self.emoji_font if is_emoji else self.regular_font
 
-    return total_width
+    def draw(self, draw: ImageDraw.ImageDraw, position, fill=(0, 0, 0)):
+        """Draws every line of the layout with its top-left corner at `position`."""
+        x, y = position
+        for i, line in enumerate(self.lines):
+            line_y = y + i * self.line_height
+            for offset, text, font in line:
+                draw.text((x + offset, line_y), text, font=font, fill=fill)
 
 
-def wrap_mixed_text(text, regular_font, emoji_font, max_width, draw):
+def layout_mixed_text(text: str, regular_font, emoji_font, max_width: float, line_spacing: float = 5) -> TextLayout:
     """
-    Wrap text that may contain emoji to fit within a specified width.
+    Wraps text that may contain emoji to fit within `max_width`, measuring
+    each word once and adding it to the current line's width.
     """
-    words = text.split(' ')
-    wrapped_lines = []
-    current_line = ""
+    layout = TextLayout(regular_font, emoji_font, line_spacing)
+    space_width = segment_width(regular_font, " ")
 
-    for word in words:
-        test_line = current_line + (word + " " if current_line else word + " ")
-        text_width, _ = get_mixed_text_bbox(test_line, regular_font, emoji_font, draw)
+    line: List[tuple] = []
+    line_width = 0.0
 
-        if text_width <= max_width:
-            current_line = test_line
-        else:
-            if current_line:
-                wrapped_lines.append(current_line.strip())
-            current_line = word + " "
+    def finish_line():
+        layout.lines.append(line)
+        layout.line_widths.append(line_width)
 
-    if current_line:
-        wrapped_lines.append(current_line.strip())
+    for word in text.split(' '):
+        word_segments = [
+            (segment, layout.font_for(is_emoji)) for segment, is_emoji in split_text_by_font(word)
+        ]
+        word_width = sum(segment_width(font, segment) for segment, font in word_segments)
 
-    return wrapped_lines
+        # Words are separated by a single space, which isn't drawn at the
+        # start of a line. Leave room for the space after the word as well,
+        # so there's a little breathing room at the end of each line.
+        start = line_width + space_width if line else 0.0
+        if line and start + word_width + space_width > max_width:
+            finish_line()
+            line, line_width, start = [], 0.0, 0.0
 
+        x = start
+        for segment, font in word_segments:
+            line.append((x, segment, font))
+            x += segment_width(font, segment)
+        line_width = x
 
-def draw_mixed_multiline_text(draw, lines, regular_font, emoji_font, position, fill=(0, 0, 0)):
-    """
-    Draw multiple lines of text with mixed fonts.
-    Returns the total width and height.
-    """
-    x, y = position
-    max_width = 0
-    # Use the larger font size for line spacing
-    line_height = max(regular_font.size, emoji_font.size) + 5  # Add some extra spacing
+    if line:
+        finish_line()
 
-    for i, line in enumerate(lines):
-        line_y = y + i * line_height
-        line_width = draw_mixed_text(draw, line, regular_font, emoji_font, (x, line_y), fill)
-        max_width = max(max_width, line_width)
+    return layout
 
-    total_height = len(lines) * line_height
-    return max_width, total_height
 
-
-def get_mixed_multiline_text_bbox(lines, regular_font, emoji_font, draw):
+def draw_mixed_text_box(draw, layout: TextLayout, position, padding=0):
     """
-    Calculate bounding box for multiple lines of mixed text.
+    Draws text with mixed fonts on an image with a background rectangle.
+
+    :param draw: ImageDraw object.
+    :param layout: The laid out text to draw.
+    :param position: Tuple (x, y) for the top-left position.
+    :param padding: Padding inside the rectangle.
+    :return: width and height of the drawn text box (including padding)
     """
-    max_width = 0
-    # Use the larger font size for line spacing
-    line_height = max(regular_font.size, emoji_font.size) + 5  # Add some extra spacing
+    text_width, text_height = layout.width, layout.height
 
-    for line in lines:
-        line_width, _ = get_mixed_text_bbox(line, regular_font, emoji_font, draw)
-        max_width = max(max_width, line_width)
+    # Adjust rectangle for padding.
+    rect_start = (position[0] - padding, position[1] - padding)
+    rect_end = (position[0] + text_width + padding,
+                position[1] + text_height + padding)
 
-    total_height = len(lines) * line_height
-    return max_width, total_height
+    # Draw the text box and text.
+    draw.rectangle([rect_start, rect_end], fill=(255, 255, 255))
+    layout.draw(draw, position, fill=(0, 0, 0))
+
+    # Return the size of the text box including padding.
+    total_width = text_width + 2 * padding
+    total_height = text_height + 2 * padding
+    return total_width, total_height
 
 
 def normalize_nick(nick: str) -> str:
@@ -588,9 +1902,88 @@ def publish_comic():
     new_comic_id = len(existing_comics) + 1
     new_comic_name = f"comic-{new_comic_id:03}.png"
 
-    # Copy the comic_strip.png to the static/comics directory.
-    shutil.copy("comic_strip.png", os.path.join(COMICS_DIR, new_comic_name))
-    print(f"Published comic as {new_comic_name}")
+    # Copy the comic_strip.png to the static/comics directory, squeezing it
+    # as small as it'll go since it's served for good.
+    published_file = os.path.join(COMICS_DIR, new_comic_name)
+    shutil.copy("comic_strip.png", published_file)
+    stats = recompress_png(published_file, "max")
+    print(f"Published comic as {new_comic_name} ({os.path.getsize(published_file):,} bytes, "
+          f"recompressed in {stats['seconds']:.2f}s)")
+
+    generate_derivatives(new_comic_name)
+
+    return new_comic_name
+
+
+def derivative_name(comic_name: str, width: int) -> str:
+    """Returns the file name of the version of `comic_name` resized to `width`."""
+    return f"{os.path.splitext(comic_name)[0]}-{width}w.webp"
+
+
+def generate_derivatives(comic_name: str, force: bool = False) -> List[str]:
+    """
+    Writes WebP versions of the published comic `comic_name` at each of
+    `DERIVATIVE_WIDTHS` narrower than the comic, and at its full width, to
+    `DERIVATIVES_DIR`. Versions that already exist are kept unless `force`.
+
+    Returns: The names of the files written.
+    """
+    os.makedirs(DERIVATIVES_DIR, exist_ok=True)
+
+    written = []
+    with Image.open(os.path.join(COMICS_DIR, comic_name)) as comic:
+        widths = [width for width in DERIVATIVE_WIDTHS if width < comic.width] + [comic.width]
+        for width in widths:
+            name = derivative_name(comic_name, width)
+            file_name = os.path.join(DERIVATIVES_DIR, name)
+            if not force and os.path.exists(file_name):
+                continue
+
+            height = round(comic.height * width / comic.width)
+            resized = comic if width == comic.width else comic.resize((width, height), Image.Resampling.LANCZOS)
+
+            # Write to a temp file first so the app never serves a partial image.
+            temp_name = f"{file_name}.part"
+            resized.save(temp_name, "WEBP", quality=DERIVATIVE_QUALITY, method=6)
+            os.replace(temp_name, file_name)
+            written.append(name)
+
+    return written
+
+
+def backfill_derivatives(force: bool = False, jobs: int = os.cpu_count() or 1):
+    """Generates the resized versions of every published comic that's missing them."""
+    comic_names = sorted(f for f in os.listdir(COMICS_DIR) if f.endswith('.png'))
+
+    # Encoding is CPU-bound, so spread it across processes rather than threads.
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(generate_derivatives, name, force): name for name in comic_names}
+        for future in as_completed(futures):
+            written = future.result()
+            if written:
+                print(f"{futures[future]}: wrote {', '.join(written)}")
+
+    print(f"Checked {len(comic_names)} comics")
+
+
+def parse_script(script_content: str):
+    """
+    Processes the raw chat logs into a list of lines of dialog and the
+    normalized speaker of each line.
+
+    Returns: A tuple of (dialog_lines, speakers).
+    """
+    # Strip off the time prefix from each line (assume the time format is
+    # always `hh:mm AM/PM `).
+    lines = script_content.strip().split("\n")
+    assert len(lines) == 6, "script.txt must contain exactly 6 lines of dialog."
+    dialog_lines = [line.strip().split(' ', 2)[2] for line in lines]
+
+    # Extract the speakers for each line.
+    speakers = [normalize_nick(line.split('>')[0][1:])
+                for line in dialog_lines]
+
+    return dialog_lines, speakers
 
 
 def load_script():
@@ -602,7 +1995,490 @@ def load_script():
         raise FileNotFoundError("script.txt file not found. Please create this file with the chat log content.")
 
 
+class Checkpoint:
+    """
+    Manifest of the stages completed by a resumable run, stored in
+    `MANIFEST_FILE` alongside the location and seed used for the comic.
+
+    Every stage records a hash of its inputs and the artifact it produced.
+    Artifacts are stored in `ARTIFACTS_DIR` under a name derived from a hash
+    of their content, and a stage's inputs include the content hashes of the
+    artifacts it depends on. A stage is only reused when its inputs are
+    unchanged, so changing the script (or any other input) redoes exactly the
+    stages downstream of the change.
+    """
+
+    def __init__(self, directory: str = "."):
+        self.manifest_path = os.path.join(directory, MANIFEST_FILE)
+        self.artifacts_dir = os.path.join(directory, ARTIFACTS_DIR)
+        self._lock = threading.Lock()
+
+        try:
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                self.manifest = json.load(f)
+        except FileNotFoundError:
+            self.manifest = {}
+        self.manifest.setdefault("stages", {})
+
+    @staticmethod
+    def hash(*inputs) -> str:
+        """Returns the hash of a stage's inputs, which must be JSON serializable."""
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def save(self):
+        """Writes the manifest to disk, replacing the old one atomically."""
+        with self._lock:
+            temp_path = f"{self.manifest_path}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(self.manifest, f, indent=4)
+            os.replace(temp_path, self.manifest_path)
+
+    def get(self, stage: str, input_hash: str) -> Optional[str]:
+        """
+        Returns the path of the artifact produced by `stage`, or None if the
+        stage hasn't been run with these inputs.
+        """
+        with self._lock:
+            entry = self.manifest["stages"].get(stage)
+        if entry is None or entry["input"] != input_hash:
+            return None
+
+        path = os.path.join(self.artifacts_dir, entry["artifact"])
+        return path if os.path.exists(path) else None
+
+    def put(self, stage: str, input_hash: str, data: bytes, extension: str) -> str:
+        """Stores the artifact produced by `stage` and returns its path."""
+        content_hash = hashlib.sha256(data).hexdigest()
+        name = f"{stage}-{content_hash[:16]}{extension}"
+        path = os.path.join(self.artifacts_dir, name)
+
+        os.makedirs(self.artifacts_dir, exist_ok=True)
+        if not os.path.exists(path):
+            with open(f"{path}.tmp", "wb") as f:
+                f.write(data)
+            os.replace(f"{path}.tmp", path)
+
+        with self._lock:
+            self.manifest["stages"][stage] = {"input": input_hash, "artifact": name, "hash": content_hash}
+        self.save()
+        return path
+
+    def get_json(self, stage: str, input_hash: str):
+        """Returns the JSON artifact produced by `stage`, or None if it needs to be run."""
+        path = self.get(stage, input_hash)
+        if path is None:
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def put_json(self, stage: str, input_hash: str, value) -> str:
+        """Stores a JSON artifact produced by `stage` and returns its path."""
+        return self.put(stage, input_hash, json.dumps(value, indent=4).encode("utf-8"), ".json")
+
+    def artifact_hash(self, stage: str) -> Optional[str]:
+        """Returns the content hash of the artifact most recently produced by `stage`."""
+        with self._lock:
+            entry = self.manifest["stages"].get(stage)
+        return entry["hash"] if entry else None
+
+    def invalidate(self, stage: str):
+        """Forgets `stage`, so that it is run again."""
+        with self._lock:
+            self.manifest["stages"].pop(stage, None)
+        self.save()
+
+
+def run_panel_stages(
+    client: OpenAI,
+    checkpoint: Checkpoint,
+    p: int,
+    prompt: str,
+    retry_policy: RetryPolicy,
+    b64: bool = False,
+    force: bool = False,
+):
+    """
+    Runs the generate and download stages for one panel of a resumable run,
+    then copies the panel to `panel_N.png`.
+
+    Args:
+        force: Generate a new image even if one was already generated for this prompt.
+    """
+    generate_stage, download_stage = f"generate_{p}", f"download_{p}"
+    if force:
+        checkpoint.invalidate(generate_stage)
+
+    # Generate image.
+    # ---------------
+
+    generate_input = Checkpoint.hash(prompt, b64)
+    image = checkpoint.get_json(generate_stage, generate_input)
+    image_data = None
+    if image is None:
+        image_url, image_b64 = request_panel_image(client, p, prompt, retry_policy, b64)
+        if image_b64:
+            # The image came back inline, so there's nothing to download. The
+            # image's hash is recorded so that the download stage's input
+            # changes whenever a new image is generated.
+            image_data = base64.b64decode(image_b64)
+            image = {"url": None, "sha256": hashlib.sha256(image_data).hexdigest()}
+        else:
+            image = {"url": image_url}
+        checkpoint.put_json(generate_stage, generate_input, image)
+
+    # Download.
+    # ---------
+
+    download_input = Checkpoint.hash(checkpoint.artifact_hash(generate_stage))
+    panel_path = checkpoint.get(download_stage, download_input)
+    if panel_path is None:
+        if image_data is None:
+            if image["url"] is None:
+                # The inline image from a previous run was lost before it
+                # was stored, so generate it again.
+                return run_panel_stages(client, checkpoint, p, prompt, retry_policy, b64, force=True)
+
+            temp_name = f"panel_{p}.download.png"
+            try:
+                download_panel(image["url"], temp_name)
+            except requests.HTTPError as e:
+                if force:
+                    raise
+
+                # Image URLs expire after a while, so generate a new image.
+                print(f"Panel {p} download failed, generating it again: {e}")
+                return run_panel_stages(client, checkpoint, p, prompt, retry_policy, b64, force=True)
+
+            with open(temp_name, "rb") as f:
+                image_data = f.read()
+            os.remove(temp_name)
+
+        panel_path = checkpoint.put(download_stage, download_input, image_data, ".png")
+    else:
+        print(f"Reusing panel {p} from {panel_path}")
+
+    shutil.copy(panel_path, f"panel_{p}.png")
+
+
+def run_pipeline(
+    client: OpenAI,
+    script: str,
+    checkpoint: Checkpoint,
+    location: Optional[str] = None,
+    panel_ids: Optional[List[int]] = None,
+    max_tries: int = MAX_TRIES,
+    concurrency: int = 3,
+    batch_prompts: bool = True,
+    b64: bool = False,
+    deadline: Optional[float] = None,
+    rotate_panels=None,
+    panel_shifts=None,
+    panel_flips=None,
+    direct: bool = True,
+    publish: bool = False,
+):
+    """
+    Generates (and optionally publishes) a comic as a series of stages: parse
+    script, describe panels, generate image and download for each panel,
+    construct and publish.
+
+    Each stage's output is checkpointed, so if a run fails part way through,
+    running it again picks up where it left off. Stages whose inputs are
+    unchanged are reused rather than run again, and the location (and the
+    seed used to pick it) is reused unless a new location is given or the
+    script has changed.
+
+    Args:
+        panel_ids: Panels to generate new images for, even if they've already been generated.
+        publish: Publish the comic, unless this exact comic has already been published.
+
+    Returns: The IDs of any panels that failed. The comic is only constructed
+    if every panel succeeded.
+    """
+    # Parse script.
+    # -------------
+
+    parse_input = Checkpoint.hash(script)
+    parsed = checkpoint.get_json("parse", parse_input)
+    if parsed is None:
+        dialog_lines, speakers = parse_script(script)
+        parsed = {"dialog_lines": dialog_lines, "speakers": speakers}
+        checkpoint.put_json("parse", parse_input, parsed)
+    dialog_lines, speakers = parsed["dialog_lines"], parsed["speakers"]
+
+    # Pick the location from a recorded seed, so a resumed run picks the same
+    # one. The seed is recorded with the script it was picked for, so a new
+    # script gets a new seed.
+    manifest = checkpoint.manifest
+    parse_hash = checkpoint.artifact_hash("parse")
+    if manifest.get("location_script") != parse_hash:
+        manifest.pop("seed", None)
+        manifest.pop("location", None)
+        manifest["location_script"] = parse_hash
+    if location is None:
+        if manifest.get("location") in LOCATIONS:
+            location = manifest["location"]
+        else:
+            seed = manifest.get("seed")
+            if seed is None:
+                seed = random.randrange(2 ** 32)
+            manifest["seed"] = seed
+            location = random.Random(seed).choice(sorted(LOCATIONS.keys()))
+    manifest["location"] = location
+    checkpoint.save()
+    print("Location:", location)
+
+    # Describe panels (speaker actions, with the names removed).
+    # ----------------------------------------------------------
+
+    describe_input = Checkpoint.hash(checkpoint.artifact_hash("parse"), batch_prompts)
+    descriptions = checkpoint.get_json("describe", describe_input)
+    if descriptions is None:
+        descriptions = {}
+        if batch_prompts:
+            try:
+                descriptions = describe_panels(client, dialog_lines, speakers)
+            except Exception as e:
+                print(f"Batched panel descriptions failed, describing panels individually: {e}")
+        for p in (1, 2, 3):
+            if p not in descriptions:
+                descriptions[p] = describe_panel(client, p, dialog_lines, speakers)
+
+        descriptions = {str(p): description for p, description in descriptions.items()}
+        checkpoint.put_json("describe", describe_input, descriptions)
+
+    # Generate and download each panel.
+    # ---------------------------------
+
+    retry_policy = RetryPolicy(max_tries=max_tries, deadline=deadline)
+    forced = set(panel_ids or [])
+    failures: Dict[int, Exception] = {}
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {
+            executor.submit(
+                run_panel_stages, client, checkpoint, p, panel_prompt(descriptions[str(p)], location),
+                retry_policy, b64, p in forced): p
+            for p in (1, 2, 3)
+        }
+
+        for future in as_completed(futures):
+            p = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                failures[p] = e
+
+    if failures:
+        for p, error in sorted(failures.items()):
+            print(f"Panel {p} failed: {error}")
+        print("Run again with --resume to retry only the failed panels.")
+        return sorted(failures)
+
+    # Construct.
+    # ----------
+
+    construct_input = Checkpoint.hash(
+        checkpoint.artifact_hash("parse"),
+        [checkpoint.artifact_hash(f"download_{p}") for p in (1, 2, 3)],
+        panel_settings(rotate_panels, panel_shifts, panel_flips),
+        direct,
+        png_profile,
+    )
+    comic_path = checkpoint.get("construct", construct_input)
+    if comic_path is None:
+        construct_comic(
+            dialog_lines, rotate_panels=rotate_panels, panel_shifts=panel_shifts, panel_flips=panel_flips,
+            direct=direct)
+        with open("comic_strip.png", "rb") as f:
+            checkpoint.put("construct", construct_input, f.read(), ".png")
+    else:
+        print(f"Reusing comic from {comic_path}")
+        shutil.copy(comic_path, "comic_strip.png")
+
+    # Publish.
+    # --------
+
+    if publish:
+        publish_input = Checkpoint.hash(checkpoint.artifact_hash("construct"))
+        published = checkpoint.get_json("publish", publish_input)
+        if published is None:
+            checkpoint.put_json("publish", publish_input, {"file": publish_comic()})
+        else:
+            print(f"Comic was already published as {published['file']}")
+
+    return []
+
+
+def load_batch(path: str) -> List[dict]:
+    """
+    Loads the scripts to generate in batch mode.
+
+    Args:
+        path: A directory of `.txt` scripts, or a JSONL file with one job per
+            line. Each job has a "script" and optionally an "id" and a
+            "location".
+
+    Returns: A list of jobs, each a dict with "id", "script" and "location" keys.
+
+    Raises:
+        ValueError: If a line isn't a JSON job with a script, if a job's ID is
+            repeated or isn't a plain file name, since each job writes to a
+            directory named after it, or if a job's location isn't one of
+            `LOCATIONS`.
+    """
+    jobs = []
+
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            if name.endswith('.txt'):
+                with open(os.path.join(path, name), "r", encoding="utf-8") as f:
+                    jobs.append({"id": name[:-len('.txt')], "script": f.read(), "location": None})
+    else:
+        with open(path, "r", encoding="utf-8") as f:
+            for line_number, line in enumerate(f, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    job = json.loads(line)
+                except ValueError as e:
+                    raise ValueError(f"Line {line_number} of {path} isn't valid JSON: {e}") from e
+
+                id = str(job.get("id", line_number))
+                if "script" not in job:
+                    raise ValueError(f"Job {id!r}: missing script")
+                jobs.append({"id": id, "script": job["script"], "location": job.get("location")})
+
+    seen = set()
+    for job in jobs:
+        id = job["id"]
+        if id in ('', '.', '..') or '/' in id or (os.altsep and os.altsep in id) or os.sep in id:
+            raise ValueError(f"Invalid job ID {id!r}: must be a plain file name")
+        if id in seen:
+            raise ValueError(f"Duplicate job ID {id!r}")
+        seen.add(id)
+
+        if job["location"] is not None and job["location"] not in LOCATIONS:
+            raise ValueError(
+                f"Invalid location {job['location']!r} for job {id!r}. Must be one of: {', '.join(LOCATIONS.keys())}")
+
+    return jobs
+
+
+def run_batch_job(client: OpenAI, job: dict, output_dir: str, render_lock: threading.Lock, **options) -> float:
+    """
+    Generates and constructs the comic for one batch job in `output_dir`.
+
+    Returns: The time taken, in seconds.
+
+    Raises:
+        RuntimeError: If any of the panels failed to generate.
+    """
+    start = time.perf_counter()
+    os.makedirs(output_dir, exist_ok=True)
+
+    with open(os.path.join(output_dir, "script.txt"), "w", encoding="utf-8") as f:
+        f.write(job["script"])
+
+    dialog_lines, speakers = parse_script(job["script"])
+
+    location = job["location"]
+    if location is None:
+        location = random.choice(list(LOCATIONS.keys()))
+    print(f"[{job['id']}] Location:", location)
+
+    direct = options.pop("direct")
+    failures = generate_panels(
+        client, [1, 2, 3], dialog_lines, speakers, location, output_dir=output_dir, **options)
+    if failures:
+        failed_ids = ' '.join(str(panel_id) for panel_id in sorted(failures))
+        raise RuntimeError(f"panel(s) {failed_ids} failed: {failures[min(failures)]}")
+
+    # The fonts are shared between jobs, and FreeType faces aren't safe to use
+    # from several threads at once, so only one comic is drawn at a time.
+    with render_lock:
+        construct_comic(dialog_lines, direct=direct, output_dir=output_dir)
+
+    return time.perf_counter() - start
+
+
+def run_batch(client: OpenAI, jobs: List[dict], output_root: str, jobs_at_once: int = 2, **options):
+    """
+    Generates comics for many scripts in one process, running up to
+    `jobs_at_once` of them at the same time.
+
+    Every job shares the same OpenAI client (and its connection pool), the
+    prompt cache and the loaded fonts. Each job's panels, comic_strip.png and
+    a copy of its script are written to `output_root/<job id>`.
+
+    Args:
+        client: The OpenAI client instance, shared by all jobs.
+        jobs: Jobs loaded with `load_batch`.
+        output_root: Directory to write each job's results into.
+        jobs_at_once: Maximum number of jobs to run at once.
+        options: Options passed on to `generate_panels` and `construct_comic`.
+    """
+    render_lock = threading.Lock()
+    durations: Dict[str, float] = {}
+    failures: Dict[str, Exception] = {}
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=jobs_at_once) as executor:
+        futures = {
+            executor.submit(
+                run_batch_job, client, job, os.path.join(output_root, job["id"]), render_lock, **options): job["id"]
+            for job in jobs
+        }
+
+        for future in as_completed(futures):
+            job_id = futures[future]
+            try:
+                durations[job_id] = future.result()
+                print(f"[{job_id}] Done in {durations[job_id]:.1f}s")
+            except Exception as e:
+                failures[job_id] = e
+                print(f"[{job_id}] Failed: {e}")
+    elapsed = time.perf_counter() - start
+
+    # Summarize the throughput of the whole batch.
+    print()
+    print(f"Batch finished in {elapsed:.1f}s: {len(durations)} succeeded, {len(failures)} failed")
+    if durations:
+        print(f"Throughput: {len(durations) / elapsed * 60:.2f} strips/minute")
+        print(f"Time per strip: {sum(durations.values()) / len(durations):.1f}s average, {max(durations.values()):.1f}s slowest")
+    if prompt_cache is not None:
+        print(prompt_cache.summary())
+    for job_id, error in sorted(failures.items()):
+        print(f"  {job_id}: {error}")
+
+
+def create_client(backend: str = "openai"):
+    """
+    Creates the client used for chat completions and image generation.
+
+    Args:
+        backend: "openai" for the real API, or "fake" for the offline stand-in
+            in `fake_openai`, configured by its `FAKE_OPENAI_*` environment variables.
+    """
+    if backend == "fake":
+        from fake_openai import FakeOpenAI
+        return FakeOpenAI.from_env()
+
+    return OpenAI()
+
+
+def report_timings(trace_file: Optional[str] = None):
+    """Prints the timing summary, and writes the full trace to `trace_file` if given."""
+    print()
+    print(tracer.summary())
+    if trace_file:
+        tracer.write(trace_file)
+        print(f"Wrote trace to {trace_file}")
+
+
 def main():
+    global prompt_cache, verbose, png_profile
+
     parser = argparse.ArgumentParser(description='Generates AI slop.')
 
     parser.add_argument(
@@ -625,6 +2501,30 @@ def main():
         help='Publish the generated comic_strip.png to the static/comics directory.'
     )
 
+    parser.add_argument(
+        '--backfill-derivatives',
+        action='store_true',
+        help=f'Generate the resized WebP versions of every published comic that is missing them, in {DERIVATIVES_DIR}. Use with --force to regenerate all of them.'
+    )
+
+    parser.add_argument(
+        '--force',
+        action='store_true',
+        help='With --backfill-derivatives, regenerate versions that already exist.'
+    )
+
+    parser.add_argument(
+        '--png-profile',
+        choices=list(PNG_PROFILES),
+        help='How hard to compress comic_strip.png: fast, balanced or max. Defaults to balanced, or to max with --recompress-archive.'
+    )
+
+    parser.add_argument(
+        '--recompress-archive',
+        action='store_true',
+        help=f'Recompress every published comic in {COMICS_DIR} in place with --png-profile, keeping any file that does not get smaller. Uses --jobs processes.'
+    )
+
     parser.add_argument(
         '-c', '--construct-only',
         action='store_true',
@@ -656,11 +2556,117 @@ def main():
         help='Flip a panel image. First argument is panel ID (1-3), second is direction (h for horizontal, v for vertical). Can be used multiple times.'
     )
 
+    parser.add_argument(
+        '--preview',
+        type=int,
+        nargs='?',
+        const=8000,
+        metavar='PORT',
+        help='Serve a page for interactively tuning panel shifts, flips and rotations using the existing panel files. Defaults to port 8000.'
+    )
+
+    parser.add_argument(
+        '--supersample',
+        action='store_true',
+        help='Draw the comic at full size and downscale it, instead of drawing it directly at its output size.'
+    )
+
     parser.add_argument(
         '-m', '--max-tries',
         type=int,
-        default=5,
-        help='Maximum number of attempts to generate each panel before giving up. Defaults to 3.'
+        default=MAX_TRIES,
+        help=f'Maximum number of attempts to generate each panel before giving up. Defaults to {MAX_TRIES}.'
+    )
+
+    parser.add_argument(
+        '-d', '--deadline',
+        type=float,
+        help='Stop retrying failed panels once this many seconds have passed since generation started. No limit if not specified.'
+    )
+
+    parser.add_argument(
+        '-j', '--concurrency',
+        type=int,
+        default=3,
+        help='Maximum number of panels to generate at the same time. Use 1 to generate panels one after another. Defaults to 3.'
+    )
+
+    parser.add_argument(
+        '--no-batch-prompts',
+        action='store_true',
+        help='Describe each panel with separate per-speaker and name-removal requests instead of one request for the whole strip.'
+    )
+
+    parser.add_argument(
+        '--b64',
+        action='store_true',
+        help='Have the API return generated panels inline as base64 instead of as a URL to download.'
+    )
+
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help=f'Always send prompts to the API instead of reusing responses cached in {PROMPT_CACHE_DIR}.'
+    )
+
+    parser.add_argument(
+        '--refresh-cache',
+        action='store_true',
+        help='Ignore cached prompt responses, but store the new responses in the cache.'
+    )
+
+    parser.add_argument(
+        '--backend',
+        choices=['openai', 'fake'],
+        default='openai',
+        help='Where to send chat and image requests. "fake" returns canned text and synthesized images without calling the API, for benchmarking and testing. Defaults to openai.'
+    )
+
+    parser.add_argument(
+        '--timings',
+        action='store_true',
+        help='Print a table of how long each stage took at the end of the run.'
+    )
+
+    parser.add_argument(
+        '--trace',
+        type=str,
+        metavar='FILE',
+        help='Write the timing of every stage to FILE as JSON, in the Chrome trace event format (viewable in Perfetto). Implies --timings.'
+    )
+
+    parser.add_argument(
+        '-v', '--verbose',
+        action='store_true',
+        help='Print the full prompts sent to and responses received from the chat API.'
+    )
+
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help=f'Checkpoint each stage of the run in {MANIFEST_FILE} and {ARTIFACTS_DIR}, reusing any stage whose inputs are unchanged since the last --resume run. Panels given with -p are always generated again. Can be combined with --publish.'
+    )
+
+    parser.add_argument(
+        '--batch',
+        type=str,
+        metavar='PATH',
+        help='Generate a comic for every script in a directory of .txt files, or every line of a JSONL file with "script", and optionally "id" and "location", fields.'
+    )
+
+    parser.add_argument(
+        '--batch-output',
+        type=str,
+        default='batch',
+        metavar='DIR',
+        help='Directory to write batch results to, with one subdirectory per script. Defaults to "batch".'
+    )
+
+    parser.add_argument(
+        '--jobs',
+        type=int,
+        default=2,
+        help='Maximum number of scripts to generate at the same time in batch mode, or of comics to process at once with --backfill-derivatives and --recompress-archive. Defaults to 2.'
     )
 
     args = parser.parse_args()
@@ -684,22 +2690,78 @@ def main():
             if direction not in ['h', 'v']:
                 parser.error(f"Flip direction must be 'h' (horizontal) or 'v' (vertical), got '{direction}'")
 
-    if args.publish:
+    if args.concurrency < 1:
+        parser.error(f"Concurrency must be at least 1, got {args.concurrency}")
+    if args.jobs < 1:
+        parser.error(f"Jobs must be at least 1, got {args.jobs}")
+
+    verbose = args.verbose
+    if args.png_profile:
+        png_profile = args.png_profile
+
+    # Report timings however the run ends, including on errors and exit().
+    if args.timings or args.trace:
+        atexit.register(report_timings, args.trace)
+
+    if args.recompress_archive:
+        recompress_archive(profile=args.png_profile or "max", jobs=args.jobs)
+        return
+
+    if args.backfill_derivatives:
+        backfill_derivatives(force=args.force, jobs=args.jobs)
+        return
+
+    if args.publish and not args.resume:
         publish_comic()
         return
 
-    # Process the raw chat logs into a list of lines of dialog, stripping off
-    # the time prefix from each line (assume the time format is always `hh:mm AM/PM `).
-    script_content = load_script()
-    lines = script_content.strip().split("\n")
-    assert len(lines) == 6, "script.txt must contain exactly 6 lines of dialog."
-    dialog_lines = [line.strip().split(' ', 2)[2] for line in lines]
+    if args.batch:
+        # Check the whole batch before anything else, so a bad batch file is
+        # reported as such rather than as, say, missing credentials.
+        try:
+            jobs = load_batch(args.batch)
+        except ValueError as e:
+            parser.error(str(e))
+
+        client = create_client(args.backend)
+        if not args.no_cache:
+            prompt_cache = PromptCache(refresh=args.refresh_cache)
+        run_batch(
+            client, jobs, args.batch_output, jobs_at_once=args.jobs, max_tries=args.max_tries,
+            concurrency=args.concurrency, batch_prompts=not args.no_batch_prompts, b64=args.b64,
+            deadline=args.deadline, direct=not args.supersample)
+        return
 
-    # Extract the speakers for each line.
-    speakers = [normalize_nick(line.split('>')[0][1:])
-                for line in dialog_lines]
+    if args.resume:
+        if args.location and args.location not in LOCATIONS:
+            parser.error(f"Invalid location: '{args.location}'. Must be one of: {', '.join(LOCATIONS.keys())}")
+
+        client = create_client(args.backend)
+        if not args.no_cache:
+            prompt_cache = PromptCache(refresh=args.refresh_cache)
+
+        failed = run_pipeline(
+            client, load_script(), Checkpoint(), location=args.location, panel_ids=args.panel,
+            max_tries=args.max_tries, concurrency=args.concurrency, batch_prompts=not args.no_batch_prompts,
+            b64=args.b64, deadline=args.deadline, rotate_panels=args.rotate, panel_shifts=args.shift,
+            panel_flips=args.flip, direct=not args.supersample, publish=args.publish)
+        if failed:
+            exit(1)
+        return
 
-    client = OpenAI()
+    # Process the raw chat logs into a list of lines of dialog.
+    dialog_lines, speakers = parse_script(load_script())
+
+    if args.preview is not None:
+        serve_preview(
+            dialog_lines, args.preview, rotate_panels=args.rotate, panel_shifts=args.shift,
+            panel_flips=args.flip, direct=not args.supersample)
+        return
+
+    client = create_client(args.backend)
+
+    if not args.no_cache:
+        prompt_cache = PromptCache(refresh=args.refresh_cache)
 
     if args.location:
         if not args.location in LOCATIONS:
@@ -714,10 +2776,25 @@ def main():
 
     if not args.construct_only:
         panels_to_generate = args.panel if args.panel else [1, 2, 3]
-        for panel_id in panels_to_generate:
-            generate_panel(client, panel_id, dialog_lines, speakers, location, args.max_tries)
+        failures = generate_panels(
+            client, panels_to_generate, dialog_lines, speakers, location, args.max_tries, args.concurrency,
+            batch_prompts=not args.no_batch_prompts, b64=args.b64, deadline=args.deadline)
+
+        if prompt_cache is not None:
+            print(prompt_cache.summary())
+
+        # Report every failed panel at once so they can all be retried with a
+        # single `-p` run, rather than constructing a comic with stale panels.
+        if failures:
+            for panel_id, error in sorted(failures.items()):
+                print(f"Panel {panel_id} failed: {error}")
+            failed_ids = ' '.join(str(panel_id) for panel_id in sorted(failures))
+            print(f"Retry with: -p {failed_ids} -l {location}")
+            exit(1)
 
-    construct_comic(dialog_lines, rotate_panels=args.rotate, panel_shifts=args.shift, panel_flips=args.flip)
+    construct_comic(
+        dialog_lines, rotate_panels=args.rotate, panel_shifts=args.shift, panel_flips=args.flip,
+        direct=not args.supersample)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,236 @@
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from PIL import Image
+from types import SimpleNamespace
+from typing import Dict, Optional
+import base64
+import io
+import itertools
+import json
+import openai
+import os
+import random
+import threading
+import time
+import zlib
+
+
+IMAGE_SIZE = (1024, 1792)
+"""The size of the images DALL-E generates for `size="1024x1792"`."""
+
+IMAGE_VARIANTS = 3
+"""Number of distinct images to synthesize. Prompts are hashed to pick one."""
+
+CANNED_DESCRIPTION = (
+    "A person with curly red hair and round glasses leans over a cluttered desk, "
+    "gesturing at a laptop while a tall person in a green hoodie looks on, unimpressed."
+)
+
+
+@lru_cache(maxsize=None)
+def synthesize_image(variant: int) -> bytes:
+    """
+    Returns a noisy PNG, which is about as large and slow to decode as a real
+    panel. Each variant is only synthesized once per process.
+    """
+    image = Image.merge("RGB", [Image.effect_noise(IMAGE_SIZE, 40 + 20 * ((variant + i) % 3)) for i in range(3)])
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+class FakeTransientError(openai.APIConnectionError):
+    """A simulated transient failure, retried like a dropped connection."""
+
+    def __init__(self, message: str = "Simulated transient error."):
+        # The real error wraps an HTTP request, which a fake call doesn't have.
+        Exception.__init__(self, message)
+        self.message = message
+        self.request = None
+        self.body = None
+        self.code = None
+        self.param = None
+        self.type = None
+
+
+class FakeContentPolicyError(openai.BadRequestError):
+    """A simulated content policy rejection, which makes the pipeline rewrite the prompt."""
+
+    def __init__(self, message: str = "Simulated content_policy_violation."):
+        Exception.__init__(self, message)
+        self.message = message
+        self.request = None
+        self.response = None
+        self.status_code = 400
+        self.request_id = None
+        self.body = None
+        self.code = "content_policy_violation"
+        self.param = None
+        self.type = None
+
+
+class FakeImageServer:
+    """
+    Serves synthesized images over HTTP, so that URL responses exercise the
+    same download path as real ones. Each image can be downloaded once.
+    """
+
+    def __init__(self):
+        self.images: Dict[str, bytes] = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+        images = self.images
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                # Like a real signed URL, an image is only fetched once, so
+                # drop it rather than holding every image ever generated.
+                body = images.pop(self.path, None)
+                if body is None:
+                    self.send_error(404)
+                    return
+
+                self.send_response(200)
+                self.send_header("Content-Type", "image/png")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def add(self, png: bytes) -> str:
+        """Serves `png` at a new URL, which is returned."""
+        with self._lock:
+            path = f"/images/{next(self._ids)}.png"
+            self.images[path] = png
+        return f"http://127.0.0.1:{self.server.server_port}{path}"
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FakeOpenAI:
+    """
+    A stand-in for the `OpenAI` client that never touches the network.
+
+    Chat completions return canned text, and JSON mode requests return a
+    description for every panel in the script. Image generations return
+    synthesized 1024x1792 PNGs, either as base64 or as a URL served locally.
+    Each call takes at least the configured latency, and fails at the
+    configured rates, so retries and concurrency behave as they would live.
+
+    Args:
+        chat_latency: Seconds each chat completion takes.
+        image_latency: Seconds each image generation takes.
+        failure_rate: Chance that a call fails with a transient error.
+        policy_rate: Chance that an image generation is rejected by the content policy.
+        seed: Seed for the failures, so runs can be repeated exactly.
+    """
+
+    def __init__(
+        self,
+        chat_latency: float = 0.0,
+        image_latency: float = 0.0,
+        failure_rate: float = 0.0,
+        policy_rate: float = 0.0,
+        seed: Optional[int] = None,
+    ):
+        self.chat_latency = chat_latency
+        self.image_latency = image_latency
+        self.failure_rate = failure_rate
+        self.policy_rate = policy_rate
+        self.calls = {"chat": 0, "image": 0, "failures": 0}
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server: Optional[FakeImageServer] = None
+
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create_completion))
+        self.images = SimpleNamespace(generate=self._generate_image)
+
+    @classmethod
+    def from_env(cls) -> "FakeOpenAI":
+        """
+        Creates a client configured by the `FAKE_OPENAI_CHAT_LATENCY`,
+        `FAKE_OPENAI_IMAGE_LATENCY`, `FAKE_OPENAI_FAILURE_RATE`,
+        `FAKE_OPENAI_POLICY_RATE` and `FAKE_OPENAI_SEED` environment variables.
+        """
+        seed = os.environ.get("FAKE_OPENAI_SEED")
+        return cls(
+            chat_latency=float(os.environ.get("FAKE_OPENAI_CHAT_LATENCY", 0)),
+            image_latency=float(os.environ.get("FAKE_OPENAI_IMAGE_LATENCY", 0)),
+            failure_rate=float(os.environ.get("FAKE_OPENAI_FAILURE_RATE", 0)),
+            policy_rate=float(os.environ.get("FAKE_OPENAI_POLICY_RATE", 0)),
+            seed=int(seed) if seed is not None else None,
+        )
+
+    def with_options(self, **kwargs) -> "FakeOpenAI":
+        """Returns this client. Options such as `max_retries` have no effect, since calls are never retried."""
+        return self
+
+    def close(self):
+        """Stops the image server, if one was started."""
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+
+    def _call(self, kind: str, latency: float, started: float):
+        """
+        Counts a call, waits until `latency` seconds after it `started`, and
+        raises if it's chosen to fail.
+        """
+        with self._lock:
+            self.calls[kind] += 1
+            fail = self._random.random() < self.failure_rate
+            if fail:
+                self.calls["failures"] += 1
+
+        time.sleep(max(0.0, latency - (time.perf_counter() - started)))
+        if fail:
+            raise FakeTransientError()
+
+    def _create_completion(self, model: str, messages: list, response_format: Optional[dict] = None, **kwargs):
+        self._call("chat", self.chat_latency, time.perf_counter())
+
+        if response_format and response_format.get("type") == "json_object":
+            content = json.dumps({"panels": [
+                {"panel": panel["panel"], "description": CANNED_DESCRIPTION}
+                for panel in json.loads(messages[-1]["content"])["panels"]
+            ]})
+        else:
+            content = CANNED_DESCRIPTION
+
+        prompt_tokens = sum(len(m["content"]) for m in messages) // 4
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+            usage=SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=len(content) // 4),
+        )
+
+    def _generate_image(self, prompt: str, response_format: str = "url", **kwargs):
+        # Synthesizing an image the first time is slow, so count it against
+        # the latency rather than adding to it.
+        started = time.perf_counter()
+        png = synthesize_image(zlib.crc32(prompt.encode()) % IMAGE_VARIANTS)
+        self._call("image", self.image_latency, started)
+
+        with self._lock:
+            rejected = self._random.random() < self.policy_rate
+        if rejected:
+            raise FakeContentPolicyError()
+
+        if response_format == "b64_json":
+            data = SimpleNamespace(b64_json=base64.b64encode(png).decode("ascii"), url=None)
+        else:
+            with self._lock:
+                if self._server is None:
+                    self._server = FakeImageServer()
+            data = SimpleNamespace(b64_json=None, url=self._server.add(png))
+
+        return SimpleNamespace(data=[data])
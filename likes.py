@@ -0,0 +1,587 @@
+from contextlib import ExitStack, contextmanager
+from typing import Callable, Dict, List, Optional, Set, Tuple
+import asyncio
+import fcntl
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import threading
+import time
+import weakref
+
+
+VOTER_HASH_BYTES = 8
+"""
+Size of the hashes voters are stored as. 64 bits keeps the chance of two
+voters on the same comic colliding negligible, and fits in a small int.
+"""
+
+
+KEY_BYTES = 32
+"""Size of the key voters are hashed with."""
+
+
+LOCK_STRIPES = 16
+"""
+Number of locks the comics are spread across, so that votes for different
+comics rarely wait on each other.
+"""
+
+
+class LikesStore:
+    """
+    The likes for every comic, kept in memory and persisted as a snapshot plus
+    an append-only log of votes.
+
+    Each new vote appends a single line to the log rather than rewriting the
+    whole database, so the cost of a vote doesn't grow with the number of
+    votes. Once the log has `compact_every` entries, it's folded into a new
+    snapshot, which is written to a temp file and renamed into place so a
+    crash never leaves a truncated snapshot. A crash mid-append can only
+    truncate the last line of the log, which is dropped when loading.
+
+    The in-memory state for each comic is guarded by one of `locks`, picked
+    by `lock_for`, so votes for different comics don't wait on each other.
+    Disk writes happen under a separate lock, only while a new vote is
+    appended, so reading like counts never waits on disk I/O.
+
+    Voters aren't stored as given. Each is replaced by a keyed hash of the
+    voter and the comic, so raw IP addresses never reach the disk and one
+    voter's votes for different comics can't be linked. Each comic's voters
+    are kept in a set, so that checking for a duplicate vote is O(1). The
+    key is random and kept apart from the votes, in `key_file` (readable
+    only by its owner) unless it's passed in, since with the key the IPv4
+    space is small enough to search. Without it, the hashes can't be
+    matched to IP addresses.
+
+    With `write_behind`, votes are applied in memory and queued, and a
+    background thread appends them to the log in batches, every
+    `flush_interval` seconds or as soon as `flush_votes` are queued. Requests
+    then never wait on disk, at the cost of losing the queued votes if the
+    process dies without calling `close`.
+
+    Several processes can share the same files, as gunicorn workers do. The
+    log and snapshot are only written under an exclusive `flock` of
+    `lock_file`, after catching up on whatever other processes have logged,
+    so no process overwrites another's votes. `sync` catches up on votes
+    logged by other processes, and is cheap enough to call before every
+    request when there's nothing new. Replaying a vote that's already been
+    counted has no effect, so processes agree on the voters for each comic
+    even if two of them accept the same vote before seeing each other's.
+
+    Args:
+        snapshot_file: The JSON snapshot of the likes, in the format
+            `{"likes": {"<id>": {"likes": 1, "voters": ["<hex hash>"]}}}`.
+            Snapshots from before voters were hashed, with a "votes" list of
+            raw IPs instead of "voters", are hashed when loaded, as are votes
+            logged with raw IPs. Snapshots that still hold their "key" have
+            it moved to `key_file`.
+        log_file: The log of votes cast since the snapshot was written.
+            Defaults to `snapshot_file` with `.log` appended.
+        lock_file: The file locked by processes writing to the log or
+            snapshot. Defaults to `snapshot_file` with `.lock` appended.
+        key: The key for hashing voters. If not given, it's read from
+            `key_file`, which is created with a random key if it doesn't exist.
+        key_file: The file holding the key for hashing voters, in hex.
+            Defaults to `snapshot_file` with `.key` appended.
+        compact_every: Number of log entries after which the log is compacted.
+        write_behind: Queue votes and write them to the log from a background
+            thread, rather than writing each one before returning.
+        flush_interval: Seconds between flushes of the queue, with `write_behind`.
+        flush_votes: Number of queued votes that triggers a flush straight
+            away, with `write_behind`.
+        fsync: Sync the log to disk after each write, so that logged votes
+            survive the machine crashing as well as the process.
+        on_change: Called with a comic ID and its new number of likes when
+            votes logged by another process are picked up.
+    """
+
+    def __init__(
+        self,
+        snapshot_file: str,
+        log_file: Optional[str] = None,
+        lock_file: Optional[str] = None,
+        compact_every: int = 1000,
+        write_behind: bool = False,
+        flush_interval: float = 0.1,
+        flush_votes: int = 100,
+        fsync: bool = False,
+        on_change: Optional[Callable[[str, int], None]] = None,
+        key: Optional[bytes] = None,
+        key_file: Optional[str] = None,
+    ):
+        self.snapshot_file = snapshot_file
+        self.log_file = log_file or f"{snapshot_file}.log"
+        self.lock_file = lock_file or f"{snapshot_file}.lock"
+        self.key_file = key_file or f"{snapshot_file}.key"
+        self.compact_every = compact_every
+        self.write_behind = write_behind
+        self.flush_interval = flush_interval
+        self.flush_votes = flush_votes
+        self.fsync = fsync
+        self.on_change = on_change
+
+        self.likes: Dict[str, int] = {}
+        '''Number of likes for each comic, keyed by comic ID.'''
+
+        self.voters: Dict[str, Set[int]] = {}
+        '''Hashes of the voters who have liked each comic, keyed by comic ID.'''
+
+        self.key = key or b''
+        '''Key for hashing voters, loaded from `key_file` unless it's passed in.'''
+
+        self.locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        '''
+        Locks guarding `likes` and `voters`. A comic's entries are written
+        under `lock_for(id)`, and replacing or reading every comic's entries
+        needs all of them, via `_all_locks`.
+        '''
+
+        # Guards the log's file descriptor and how far through it we've read.
+        # It's always taken before the file lock.
+        self._log_lock = threading.Lock()
+        self._log_fd = -1
+        self._log_inode = None
+        self._log_offset = 0
+        self._log_entries = 0
+        self._lock_fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+        self._needs_compaction = False
+
+        self._queue: List[bytes] = []
+        self._queue_changed = threading.Condition()
+        self._closed = False
+        self._flusher = None
+        self._flushes = 0
+        self._flushed_votes = 0
+        self._flush_time = 0.0
+        self._max_flush_time = 0.0
+
+        self.load()
+        self._start_flusher()
+
+        # A forked process, like a worker of a preloaded gunicorn app, shares
+        # our open files, and `flock` doesn't lock out other holders of the
+        # same open file, so it needs to open its own.
+        store = weakref.ref(self)
+        os.register_at_fork(after_in_child=lambda: store() is not None and store()._after_fork())
+
+    def _start_flusher(self):
+        if self.write_behind:
+            self._flusher = threading.Thread(target=self._flush_queue, name="likes-flusher", daemon=True)
+            self._flusher.start()
+
+    def _after_fork(self):
+        """Gives a forked process its own locks, files and flusher thread."""
+        self.locks = [threading.Lock() for _ in self.locks]
+        self._log_lock = threading.Lock()
+        self._queue_changed = threading.Condition()
+
+        # The parent writes out the votes it queued.
+        self._queue = []
+
+        if self._closed:
+            return
+
+        os.close(self._lock_fd)
+        self._lock_fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+
+        # Our own descriptor for the log is opened when it's next read, by
+        # reloading from the snapshot.
+        os.close(self._log_fd)
+        self._log_fd = -1
+        self._log_inode = None
+
+        self._start_flusher()
+
+    @contextmanager
+    def _file_lock(self):
+        """Holds `_log_lock` and the exclusive lock on `lock_file`, which is shared with other processes."""
+        with self._log_lock:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    def load(self):
+        """Loads the snapshot and replays the log on top of it."""
+        with self._file_lock():
+            if not self.key:
+                self.key = self._load_key()
+            if len(self.key) < KEY_BYTES:
+                raise ValueError(f"The key for hashing voters must be at least {KEY_BYTES} bytes")
+            self._load_locked()
+
+            # Rewrite anything left from older versions, so that neither raw
+            # IPs nor the key stay on disk next to the votes.
+            if self._needs_compaction:
+                self._compact_locked()
+
+    def _load_key(self) -> bytes:
+        """
+        Reads the key from `key_file`, creating it if it doesn't exist. Must
+        be called while holding the file lock, so that processes starting at
+        the same time agree on the key.
+        """
+        try:
+            with open(self.key_file, 'r') as f:
+                return bytes.fromhex(f.read().strip())
+        except FileNotFoundError:
+            pass
+        except ValueError as e:
+            raise ValueError(f"{self.key_file} doesn't hold a key in hex: {e}") from e
+
+        # Older snapshots kept the key alongside the votes. Move it out.
+        try:
+            with open(self.snapshot_file, 'r') as f:
+                key = json.load(f).get('key')
+        except FileNotFoundError:
+            key = None
+        key = bytes.fromhex(key) if key else secrets.token_bytes(KEY_BYTES)
+
+        fd = os.open(self.key_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(key.hex())
+            f.flush()
+            os.fsync(f.fileno())
+        return key
+
+    def _load_locked(self) -> Dict[str, int]:
+        """
+        Loads the snapshot and replays the log on top of it. Must be called
+        while holding the file lock.
+
+        Returns: The comics whose number of likes changed, with their new likes.
+        """
+        try:
+            with open(self.snapshot_file, 'r') as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            snapshot = {}
+
+        self._needs_compaction = 'key' in snapshot
+
+        with self._all_locks():
+            old_likes = self.likes
+            self.likes = {}
+            self.voters = {}
+
+            for id, comic_data in snapshot.get('likes', {}).items():
+                if 'voters' in comic_data:
+                    voters = {int(voter, 16) for voter in comic_data['voters']}
+                else:
+                    voters = {self.hash_voter(id, ip) for ip in comic_data.get('votes', [])}
+                    self._needs_compaction = True
+                self.voters[id] = voters
+                self.likes[id] = comic_data.get('likes', len(voters))
+
+        if self._log_fd >= 0:
+            os.close(self._log_fd)
+        self._log_fd = os.open(self.log_file, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        self._log_inode = os.fstat(self._log_fd).st_ino
+        self._log_offset = 0
+        self._log_entries = 0
+        self._read_log()
+
+        # Votes still queued with `write_behind` aren't in the log yet, so
+        # apply them again rather than having them disappear until the next
+        # flush.
+        with self._queue_changed:
+            queued = [json.loads(line) for line in self._queue]
+
+        with self._all_locks():
+            for entry in queued:
+                self._apply(entry['id'], int(entry['hash'], 16))
+            return {id: likes for id, likes in self.likes.items() if old_likes.get(id) != likes}
+
+    def _read_log(self) -> Dict[str, int]:
+        """
+        Applies the complete lines added to the log since it was last read.
+        Must be called while holding `_log_lock`.
+
+        Returns: The comics whose number of likes changed, with their new likes.
+        """
+        size = os.fstat(self._log_fd).st_size
+        if size <= self._log_offset:
+            return {}
+
+        # Stop at the last complete line. Anything after it is either being
+        # written right now, or was cut off by a crash mid-write.
+        data = os.pread(self._log_fd, size - self._log_offset, self._log_offset)
+        data = data[:data.rfind(b'\n') + 1]
+
+        changed = {}
+        with self._all_locks():
+            for line in data.splitlines():
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+
+                if 'hash' in entry:
+                    voter = int(entry['hash'], 16)
+                else:
+                    voter = self.hash_voter(entry['id'], entry['voter'])
+                    self._needs_compaction = True
+                likes, added = self._apply(entry['id'], voter)
+                if added:
+                    changed[entry['id']] = likes
+                self._log_entries += 1
+
+        self._log_offset += len(data)
+        return changed
+
+    def _catch_up_locked(self) -> Dict[str, int]:
+        """
+        Brings the in-memory state up to date with whatever other processes
+        have written. Must be called while holding the file lock.
+
+        Returns: The comics whose number of likes changed, with their new likes.
+        """
+        # A process that compacts the log replaces it with an empty one, so
+        # start again from the snapshot it wrote.
+        try:
+            inode = os.stat(self.log_file).st_ino
+        except FileNotFoundError:
+            inode = None
+        if inode != self._log_inode:
+            return self._load_locked()
+
+        changed = self._read_log()
+
+        # No one else can be writing while we hold the lock, so anything after
+        # the last complete line was cut off by a crash. Drop it so that new
+        # entries start on a fresh line.
+        if os.fstat(self._log_fd).st_size > self._log_offset:
+            os.truncate(self.log_file, self._log_offset)
+
+        return changed
+
+    def sync(self):
+        """Picks up votes logged by other processes since the last call."""
+        try:
+            stat = os.stat(self.log_file)
+        except FileNotFoundError:
+            stat = None
+
+        # If the log is the same file and the same size, nothing's changed.
+        if stat is not None and stat.st_ino == self._log_inode and stat.st_size == self._log_offset:
+            return
+
+        with self._file_lock():
+            changed = self._catch_up_locked()
+        self._notify(changed)
+
+    def _notify(self, changed: Dict[str, int]):
+        if self.on_change is not None:
+            for id, likes in changed.items():
+                self.on_change(id, likes)
+
+    def lock_for(self, id: str) -> threading.Lock:
+        """Returns the lock guarding the likes and voters of the comic `id`."""
+        return self.locks[hash(id) % len(self.locks)]
+
+    @contextmanager
+    def _all_locks(self):
+        """Holds every lock in `locks`, always taken in the same order."""
+        with ExitStack() as stack:
+            for lock in self.locks:
+                stack.enter_context(lock)
+            yield
+
+    def get(self, id: str) -> int:
+        """Returns the number of likes for the comic `id`."""
+        with self.lock_for(id):
+            return self.likes.get(id, 0)
+
+    def hash_voter(self, id: str, voter: str) -> int:
+        """
+        Returns the hash that `voter` is stored as for the comic `id`. The
+        comic is part of the hash, so a voter's votes for different comics
+        can't be linked to each other.
+        """
+        digest = hmac.new(self.key, f"{id}\0{voter}".encode(), hashlib.sha256).digest()
+        return int.from_bytes(digest[:VOTER_HASH_BYTES], 'big')
+
+    def _apply(self, id: str, voter: int) -> Tuple[int, bool]:
+        """
+        Records a vote by the hashed `voter` in memory. Must be called with
+        `lock_for(id)` or all of `locks` held.
+
+        Returns: A tuple of (number of likes, whether the vote was new).
+        """
+        voters = self.voters.setdefault(id, set())
+        if voter in voters:
+            return self.likes.get(id, 0), False
+
+        voters.add(voter)
+        self.likes[id] = self.likes.get(id, 0) + 1
+        return self.likes[id], True
+
+    def like(self, id: str, voter: str) -> int:
+        """
+        Records a vote for the comic `id` by `voter`, unless they've already
+        voted for it.
+
+        Returns: The number of likes for the comic.
+        """
+        # Only this comic's lock is held to check for a duplicate, so votes
+        # for other comics, and duplicate votes, never wait on the log.
+        voter_hash = self.hash_voter(id, voter)
+        with self.lock_for(id):
+            likes, added = self._apply(id, voter_hash)
+        if not added:
+            return likes
+
+        line = self._log_line(id, voter_hash)
+        if self.write_behind:
+            with self._queue_changed:
+                self._queue.append(line)
+                if len(self._queue) >= self.flush_votes:
+                    self._queue_changed.notify()
+            return likes
+
+        # Another process may have logged the same vote since we last caught
+        # up, but logging it twice has no effect, so the log only needs to be
+        # locked while the vote is appended.
+        with self._file_lock():
+            changed = self._catch_up_locked()
+            changed.update(self._append_locked([line]))
+
+        self._notify(changed)
+        return self.get(id)
+
+    async def like_async(self, id: str, voter: str) -> int:
+        """
+        Like `like`, but for async servers. With `write_behind`, a vote only
+        touches memory, so it's recorded without leaving the event loop.
+        Otherwise it waits on the log, so it's recorded in a worker thread.
+
+        Returns: The number of likes for the comic.
+        """
+        if self.write_behind:
+            return self.like(id, voter)
+        return await asyncio.to_thread(self.like, id, voter)
+
+    @staticmethod
+    def _log_line(id: str, voter_hash: int) -> bytes:
+        return json.dumps({'id': id, 'hash': f"{voter_hash:016x}"}).encode() + b'\n'
+
+    def _append_locked(self, lines: List[bytes]) -> Dict[str, int]:
+        """
+        Appends `lines` to the log, compacting it if it's grown too long.
+        Must be called while holding the file lock, after catching up.
+
+        Returns: The comics whose number of likes changed, with their new likes.
+        """
+        start = time.perf_counter()
+
+        # A single write to a file opened for appending lands in one piece.
+        os.write(self._log_fd, b''.join(lines))
+        if self.fsync:
+            os.fsync(self._log_fd)
+
+        elapsed = time.perf_counter() - start
+        with self._queue_changed:
+            self._flushes += 1
+            self._flushed_votes += len(lines)
+            self._flush_time += elapsed
+            self._max_flush_time = max(self._max_flush_time, elapsed)
+
+        # Read the lines back rather than skipping over them. With
+        # `write_behind`, catching up may have reloaded the snapshot since
+        # they were applied, and they must be in memory before compacting.
+        changed = self._read_log()
+        if self._log_entries >= self.compact_every:
+            self._compact_locked()
+        return changed
+
+    def _flush_queue(self):
+        """Writes queued votes to the log until `close` is called."""
+        while True:
+            with self._queue_changed:
+                self._queue_changed.wait_for(
+                    lambda: self._closed or len(self._queue) >= self.flush_votes, timeout=self.flush_interval)
+                lines, self._queue = self._queue, []
+                closed = self._closed
+
+            if lines:
+                with self._file_lock():
+                    changed = self._catch_up_locked()
+                    changed.update(self._append_locked(lines))
+                self._notify(changed)
+            if closed:
+                return
+
+    def close(self):
+        """Writes any queued votes to the log and closes it."""
+        with self._queue_changed:
+            self._closed = True
+            self._queue_changed.notify()
+
+        if self._flusher is not None:
+            self._flusher.join()
+
+        with self._log_lock:
+            if self._log_fd >= 0:
+                os.close(self._log_fd)
+                self._log_fd = -1
+
+    def stats(self) -> dict:
+        """
+        Returns the number of votes waiting to be written, and the number and
+        latency of the writes made to the log so far.
+        """
+        with self._queue_changed:
+            return {
+                'queue_depth': len(self._queue),
+                'flushes': self._flushes,
+                'flushed_votes': self._flushed_votes,
+                'mean_flush_ms': self._flush_time / self._flushes * 1000 if self._flushes else 0.0,
+                'max_flush_ms': self._max_flush_time * 1000,
+            }
+
+    def compact(self):
+        """Writes a new snapshot of all the likes and empties the log."""
+        with self._file_lock():
+            changed = self._catch_up_locked()
+            self._compact_locked()
+        self._notify(changed)
+
+    def _compact_locked(self):
+        """
+        Writes a new snapshot of all the likes and replaces the log with an
+        empty one. Must be called while holding the file lock, after
+        catching up.
+        """
+        with self._all_locks():
+            snapshot = {
+                'likes': {
+                    id: {'likes': self.likes.get(id, 0), 'voters': [f"{voter:016x}" for voter in voters]}
+                    for id, voters in self.voters.items()
+                }
+            }
+
+        temp_name = f"{self.snapshot_file}.{os.getpid()}.tmp"
+        with open(temp_name, 'w') as f:
+            json.dump(snapshot, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_name, self.snapshot_file)
+        self._needs_compaction = False
+
+        # Replace the log rather than truncating it, so that other processes
+        # can tell from its inode that they need to reload the snapshot. Any
+        # votes still queued with `write_behind` are in the snapshot already,
+        # and are harmlessly logged again when they're flushed.
+        temp_name = f"{self.log_file}.{os.getpid()}.tmp"
+        open(temp_name, 'wb').close()
+        os.replace(temp_name, self.log_file)
+
+        os.close(self._log_fd)
+        self._log_fd = os.open(self.log_file, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        self._log_inode = os.fstat(self._log_fd).st_ino
+        self._log_offset = 0
+        self._log_entries = 0
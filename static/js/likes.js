@@ -4,6 +4,23 @@
 document.addEventListener('DOMContentLoaded', () => {
     const likeButtons = document.querySelectorAll('.like-button');
 
+    // Pages may be served from a cache, so fetch the current number of likes
+    // for every strip on the page and update the buttons with them.
+    const ids = Array.from(likeButtons, button => button.getAttribute('data-id'));
+    if (ids.length > 0) {
+        fetch(`/likes?ids=${ids.join(',')}`)
+        .then(response => response.ok ? response.json() : {})
+        .then(likes => {
+            likeButtons.forEach(button => {
+                const count = likes[button.getAttribute('data-id')];
+                if (count !== undefined && !button.textContent.startsWith('🌟')) {
+                    button.textContent = `⭐ ${count}`;
+                }
+            });
+        })
+        .catch(error => console.error('Error:', error));
+    }
+
     likeButtons.forEach(button => {
         button.addEventListener('click', event => {
             event.preventDefault();